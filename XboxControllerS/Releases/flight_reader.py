@@ -0,0 +1,86 @@
+import argparse
+import struct
+import time
+import evdev
+from evdev import ecodes
+
+# Must match the flight recorder in ver21.py
+FLIGHT_MAGIC = b'WHISKFR1'
+FLIGHT_HEADER = struct.Struct('<8sHIQ')  # magic, record size, records in file, records ever made
+FLIGHT_RECORD = struct.Struct('<dBxHHi')  # time, source, type, code, value
+SOURCES = ['keyboard', 'mouse', 'output']
+
+parser = argparse.ArgumentParser(description="Print or replay a whisk flight recorder dump.")
+parser.add_argument('dump', help="whisk-flight-*.bin file")
+parser.add_argument('--source', default='keyboard,mouse,output',
+                    help="comma separated sources to show (keyboard, mouse, output)")
+parser.add_argument('--no-syn', action='store_true', help="hide EV_SYN records")
+parser.add_argument('--replay', action='store_true',
+                    help="instead of printing, feed the recorded keyboard and mouse events back in through "
+                         "two uinput devices at their original pace; start ver21.py with the --keyboard and "
+                         "--mouse paths this prints")
+parser.add_argument('--speed', type=float, default=1.0, help="replay speed factor")
+args = parser.parse_args()
+
+def read_dump(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, record_size, count, total = FLIGHT_HEADER.unpack_from(data)
+    if magic != FLIGHT_MAGIC or record_size != FLIGHT_RECORD.size:
+        raise SystemExit(f"'{path}' is not a flight recorder dump this reader understands.")
+    records = list(FLIGHT_RECORD.iter_unpack(data[FLIGHT_HEADER.size:FLIGHT_HEADER.size + count * record_size]))
+    return records, total
+
+def event_name(etype, code):
+    names = ecodes.bytype.get(etype, {}).get(code, code)
+    if isinstance(names, (list, tuple)):
+        names = names[0]
+    return f"{ecodes.EV.get(etype, etype)} {names}"
+
+def print_records(records, total):
+    wanted = {SOURCES.index(name.strip()) for name in args.source.split(',') if name.strip() in SOURCES}
+    print(f"{len(records)} of {total} recorded events")
+    if not records:
+        return
+    start = records[0][0]
+    for t, source, etype, code, value in records:
+        if source not in wanted or (args.no_syn and etype == ecodes.EV_SYN):
+            continue
+        print(f"{t - start:12.6f}  {SOURCES[source]:8}  {event_name(etype, code):32} {value}")
+
+def replay(records):
+    # Kernel SYN_DROPPED markers are left out, the replayed stream itself lost nothing
+    inputs = [r for r in records if r[1] != SOURCES.index('output') and
+              not (r[2] == ecodes.EV_SYN and r[3] == ecodes.SYN_DROPPED)]
+    if not inputs:
+        print("No input events to replay.")
+        return
+    keyboard = evdev.UInput({ecodes.EV_KEY: list(ecodes.KEY.keys() & range(1, 249))},
+                            name="whisk replay keyboard")
+    mouse = evdev.UInput({ecodes.EV_KEY: [ecodes.BTN_LEFT, ecodes.BTN_RIGHT, ecodes.BTN_MIDDLE,
+                                          ecodes.BTN_SIDE, ecodes.BTN_EXTRA],
+                          ecodes.EV_REL: [ecodes.REL_X, ecodes.REL_Y, ecodes.REL_WHEEL, ecodes.REL_HWHEEL,
+                                          ecodes.REL_WHEEL_HI_RES, ecodes.REL_HWHEEL_HI_RES]},
+                         name="whisk replay mouse")
+    devices = [keyboard, mouse]
+    print(f"Replay devices ready. Start the translator on them with:\n"
+          f"  python ver21.py --keyboard {keyboard.device.path} --mouse {mouse.device.path}")
+    input("Press Enter once it is running to start the replay.")
+    print(f"Replaying {len(inputs)} events.")
+    first = inputs[0][0]
+    began = time.monotonic()
+    try:
+        for t, source, etype, code, value in inputs:
+            delay = began + (t - first) / args.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            devices[source].write(etype, code, value)
+    finally:
+        for device in devices:
+            device.close()
+
+records, total = read_dump(args.dump)
+if args.replay:
+    replay(records)
+else:
+    print_records(records, total)
@@ -2,38 +2,187 @@ import uinput
 import evdev
 import threading
 import time
+import select
+import struct
+import ctypes
+import marshal
+import argparse
+import heapq
+import math
+import itertools
 from collections import deque
-from Xlib import display, X
 import sys
 import os
+import signal
+import atexit
+import bisect
+import socket
+import stat
+
+parser = argparse.ArgumentParser(description="Translate keyboard and mouse input into a virtual Xbox controller.")
+parser.add_argument('--keyboard', metavar='PATH',
+                    help="read this keyboard (e.g. /dev/input/by-id/...-kbd) instead of the first one found")
+parser.add_argument('--mouse', metavar='PATH',
+                    help="read this mouse instead of the first one found")
+parser.add_argument('--strict-keymap', action='store_true',
+                    help="refuse keymaps with unknown, shadowed or conflicting bindings instead of warning")
+parser.add_argument('--hires-axes', action='store_true',
+                    help="use 16-bit axes like a real Xbox pad (sticks -32768..32767, triggers 0..65535)")
+parser.add_argument('--grab-keyboard', action='store_true',
+                    help="grab the keyboard exclusively (EVIOCGRAB) so only the virtual pad sees it")
+parser.add_argument('--no-autorepeat', action='store_true',
+                    help="with --grab-keyboard, switch kernel key repeat off while running (EVIOCSREP)")
+parser.add_argument('--suspend-unfocused', action='store_true',
+                    help="release the pad, grabs and centering while a window not named by any profile's "
+                         "WM_CLASS (or --focus-whitelist) has focus")
+parser.add_argument('--focus-whitelist', default='', metavar='CLASS[,CLASS...]',
+                    help="extra WM_CLASS names that keep translation running with --suspend-unfocused")
+parser.add_argument('--no-x', action='store_true',
+                    help="run without an X server (KMS/DRM, gamescope): Xlib is never imported, the mouse "
+                         "is grabbed with EVIOCGRAB instead of an X pointer grab and there is no centering")
+parser.add_argument('--log-level', default='info', choices=['debug', 'info', 'warning', 'error'],
+                    help="least severe message that is written")
+parser.add_argument('--log-file', metavar='PATH',
+                    help="append messages (timestamped) to this file instead of the terminal")
+parser.add_argument('--log-journal', action='store_true',
+                    help="send messages to the systemd journal (needs python-systemd)")
+parser.add_argument('--flight-records', type=int, default=65536, metavar='N',
+                    help="how many input events and output writes the flight recorder keeps")
+parser.add_argument('--flight-dir', default='.', metavar='DIR',
+                    help="where flight recorder dumps are written")
+parser.add_argument('--metrics', metavar='ADDRESS',
+                    help="serve Prometheus text metrics on unix:/path/to/socket, HOST:PORT or PORT (localhost)")
+args = parser.parse_args()
+
+# Axis ranges. Config values (TRIGGER_MAX, macro axis values, sensitivity steps) stay on the
+# 0..255 scale and are converted once when a profile is compiled.
+if args.hires_axes:
+    STICK_MIN, STICK_CENTER, STICK_MAX, TRIGGER_FULL = -32768, 0, 32767, 65535
+else:
+    STICK_MIN, STICK_CENTER, STICK_MAX, TRIGGER_FULL = 0, 128, 255, 255
+STICK_UNIT = (STICK_MAX - STICK_MIN + 1) // 256  # stick units per step of the 0..255 scale
+
+# Logging: log() only appends to a bounded queue and wakes the writer thread, so a slow
+# terminal, pipe or disk never stalls input translation. When the queue is full the message
+# is dropped and counted instead.
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LOG_LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LOG_LEVEL_NAMES = {level: name.upper() for name, level in LOG_LEVELS.items()}
+JOURNAL_PRIORITIES = {DEBUG: 7, INFO: 6, WARNING: 4, ERROR: 3}
+LOG_QUEUE_SIZE = 1024
+
+log_level = LOG_LEVELS[args.log_level]
+log_queue = deque()  # (level, time, message); append/popleft are atomic
+log_wake_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+log_dropped = 0
+log_closing = False
+log_file = None
+journal = None
+
+if args.log_journal:
+    try:
+        from systemd import journal
+    except ImportError:
+        print("--log-journal needs python-systemd, logging to the terminal.")
+elif args.log_file:
+    log_file = open(args.log_file, 'a')
+
+def log(message, level=INFO):
+    global log_dropped
+    if level < log_level:
+        return
+    if len(log_queue) >= LOG_QUEUE_SIZE:
+        log_dropped += 1
+        return
+    log_queue.append((level, time.time(), message))
+    os.eventfd_write(log_wake_fd, 1)
+
+def write_log_record(level, stamp, message):
+    if journal is not None:
+        journal.send(message, PRIORITY=JOURNAL_PRIORITIES[level], SYSLOG_IDENTIFIER='whisk')
+    elif log_file is not None:
+        clock = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stamp))
+        log_file.write(f"{clock}.{int(stamp * 1000) % 1000:03d} {LOG_LEVEL_NAMES[level]} {message}\n")
+    else:
+        sys.stdout.write(message + '\n')
+
+def log_writer_thread():
+    while True:
+        select.select([log_wake_fd], [], [])
+        os.eventfd_read(log_wake_fd)
+        while log_queue:
+            try:
+                write_log_record(*log_queue.popleft())
+            except (OSError, ValueError):
+                pass  # closed terminal or file; the message is lost either way
+        try:
+            (log_file or sys.stdout).flush()
+        except (OSError, ValueError):
+            pass
+        if log_closing:
+            break
 
-# Initialize X11 display for cursor warping and grabbing
-disp = display.Display()
-root = disp.screen().root
+def stop_logging():
+    """Write out whatever is still queued and stop the writer (also runs at exit)."""
+    global log_closing
+    if log_closing:
+        return
+    log_closing = True
+    os.eventfd_write(log_wake_fd, 1)
+    log_writer.join(timeout=2.0)
+    if log_dropped:
+        print(f"{log_dropped} log messages dropped (queue full).", file=sys.stderr)
+
+log_writer = threading.Thread(target=log_writer_thread, daemon=True)
+log_writer.start()
+atexit.register(stop_logging)
+
+# Initialize X11 display for cursor warping and grabbing. Xlib is the heaviest import, so
+# headless runs never load it.
+if args.no_x:
+    disp = root = None
+else:
+    from Xlib import display, X
+    from Xlib.ext import randr
+    disp = display.Display()
+    root = disp.screen().root
 
-print("Detected input devices:")
+log("Detected input devices:")
 devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
 for d in devices:
-    print(f"{d.path}: {d.name}")
+    log(f"{d.path}: {d.name}")
+
+def open_device(path, kind):
+    try:
+        d = evdev.InputDevice(path)
+    except OSError as e:
+        log(f"Cannot open {kind} '{path}': {e}", ERROR)
+        return None
+    log(f"Selected {kind}: {d.name} at {d.path}")
+    return d
 
 def find_keyboard():
+    if args.keyboard:
+        return open_device(args.keyboard, "keyboard")
     for d in devices:
         caps = d.capabilities()
         if evdev.ecodes.EV_KEY in caps:
             keys = caps[evdev.ecodes.EV_KEY]
             if evdev.ecodes.KEY_A in keys and evdev.ecodes.KEY_Z in keys:
-                print(f"Selected keyboard: {d.name} at {d.path}")
+                log(f"Selected keyboard: {d.name} at {d.path}")
                 return d
     return None
 
 def find_mouse():
+    if args.mouse:
+        return open_device(args.mouse, "mouse")
     for d in devices:
         caps = d.capabilities()
         if evdev.ecodes.EV_REL in caps and evdev.ecodes.EV_KEY in caps:
             rels = caps[evdev.ecodes.EV_REL]
             keys = caps[evdev.ecodes.EV_KEY]
             if evdev.ecodes.REL_X in rels and evdev.ecodes.REL_Y in rels and evdev.ecodes.BTN_LEFT in keys:
-                print(f"Selected mouse: {d.name} at {d.path}")
+                log(f"Selected mouse: {d.name} at {d.path}")
                 return d
     return None
 
@@ -41,11 +190,11 @@ keyboard = find_keyboard()
 mouse = find_mouse()
 
 if not keyboard or not mouse:
-    print("ERROR: Could not find keyboard or mouse input devices")
+    log("ERROR: Could not find keyboard or mouse input devices", ERROR)
     sys.exit(1)
 
-print(f"Using keyboard: {keyboard.name} at {keyboard.path}")
-print(f"Using mouse: {mouse.name} at {mouse.path}")
+log(f"Using keyboard: {keyboard.name} at {keyboard.path}")
+log(f"Using mouse: {mouse.name} at {mouse.path}")
 
 # Default mappings (hardcoded). Will be overridden if config file loaded.
 
@@ -71,9 +220,12 @@ DEFAULT_KEYMAP = {
     'ABS_LEFT_STICK_X_NEG': 'KEY_A',
     'ABS_LEFT_STICK_Y_POS': 'KEY_S',
     'ABS_LEFT_STICK_Y_NEG': 'KEY_W',
-    # Mouse buttons for triggers (special handling in mouse_thread)
-    'RIGHT_TRIGGER_MOUSE': evdev.ecodes.BTN_LEFT,
-    'LEFT_TRIGGER_MOUSE': evdev.ecodes.BTN_MIDDLE,
+    # Mouse buttons for the analog triggers (shorthand for MOUSE_<button>=RIGHT/LEFT_TRIGGER)
+    'RIGHT_TRIGGER_MOUSE': 'BTN_LEFT',
+    'LEFT_TRIGGER_MOUSE': 'BTN_MIDDLE',
+    # Optional keyboard keys for the analog triggers
+    'LEFT_TRIGGER_KEY': None,
+    'RIGHT_TRIGGER_KEY': None,
 }
 
 CONFIG_FILENAME = 'whisk_keymap.conf'
@@ -86,7 +238,7 @@ def load_keymap_from_file(filepath):
             if not line or line.startswith('#'):
                 continue
             if '=' not in line:
-                print(f"Skipping invalid line in keymap file: {line}")
+                log(f"Skipping invalid line in keymap file: {line}", WARNING)
                 continue
             key, val = line.split('=', 1)
             key = key.strip()
@@ -103,68 +255,373 @@ def parse_evdev_key(keyname):
         return getattr(evdev.ecodes, keyname, None)
     return None
 
-print(f"Looking for config file '{CONFIG_FILENAME}' in current directory: {os.getcwd()}")
-loaded_keymap = {}
-if os.path.isfile(CONFIG_FILENAME):
-    try:
-        raw_map = load_keymap_from_file(CONFIG_FILENAME)
-        # Parse and map keys, also handle dual keys for axis if provided
-        # Use keys from config or fallback to default
-        loaded_keymap = {}
-
-        # First parse normal buttons
-        def get_key(k, default=None):
-            return raw_map.get(k, default)
-
-        # Map all keys similarly, including axis with dual keys
-        # For axis keys, split comma separated keys
-        # Left Stick X
-        xs = get_key('ABS_LEFT_STICK_X', None)
-        if xs and ',' in xs:
-            pos_key, neg_key = [k.strip() for k in xs.split(',',1)]
-        else:
-            pos_key = get_key('ABS_LEFT_STICK_X_POS', DEFAULT_KEYMAP['ABS_LEFT_STICK_X_POS'])
-            neg_key = get_key('ABS_LEFT_STICK_X_NEG', DEFAULT_KEYMAP['ABS_LEFT_STICK_X_NEG'])
-        # Left Stick Y
-        ys = get_key('ABS_LEFT_STICK_Y', None)
-        if ys and ',' in ys:
-            posy_key, negy_key = [k.strip() for k in ys.split(',',1)]
+# Controller buttons driven by a single key, in the order the old elif chain
+# checked them (the first binding wins when one key is bound twice)
+BUTTON_OUTPUTS = {
+    'BTN_THUMBL': uinput.BTN_THUMBL,
+    'BTN_THUMBR': uinput.BTN_THUMBR,
+    'BTN_A': uinput.BTN_A,
+    'BTN_B': uinput.BTN_B,
+    'BTN_X': uinput.BTN_X,
+    'BTN_Y': uinput.BTN_Y,
+    'BTN_TL': uinput.BTN_TL,
+    'BTN_TR': uinput.BTN_TR,
+    'BTN_TL2': uinput.BTN_TL2,
+    'BTN_TR2': uinput.BTN_TR2,
+    'BTN_MODE': uinput.BTN_MODE,
+    'BTN_START': uinput.BTN_START,
+    'BTN_SELECT': uinput.BTN_SELECT,
+    'BTN_DPAD_UP': uinput.BTN_DPAD_UP,
+    'BTN_DPAD_DOWN': uinput.BTN_DPAD_DOWN,
+    'BTN_DPAD_LEFT': uinput.BTN_DPAD_LEFT,
+    'BTN_DPAD_RIGHT': uinput.BTN_DPAD_RIGHT,
+}
+
+# Left stick keys: keymap entry -> direction bit in the held-direction bitset
+STICK_X_POS, STICK_X_NEG, STICK_Y_POS, STICK_Y_NEG = 1, 2, 4, 8
+AXIS_OUTPUTS = {
+    'ABS_LEFT_STICK_X_POS': STICK_X_POS,
+    'ABS_LEFT_STICK_X_NEG': STICK_X_NEG,
+    'ABS_LEFT_STICK_Y_POS': STICK_Y_POS,
+    'ABS_LEFT_STICK_Y_NEG': STICK_Y_NEG,
+}
+# Pressing a direction records it as the latest one on its axis: bit -> (order mask, order value).
+# Order bit 1 = X went positive last, order bit 2 = Y went positive last.
+STICK_ORDER_ON_PRESS = {
+    STICK_X_POS: (1, 1),
+    STICK_X_NEG: (1, 0),
+    STICK_Y_POS: (2, 2),
+    STICK_Y_NEG: (2, 0),
+}
+SOCD_POLICIES = ('last', 'neutral', 'first')
+STICK_GATES = ('circle', 'square')
+
+def build_stick_table(policy, gate, exponent=1.0, cap=1.0):
+    """Precompute left stick ramp targets (x, y) for every held-direction bitset and press order.
+
+    Index is held_bits | order << 4; targets are signed ramp positions in -1..1. Opposite
+    directions held together resolve per the SOCD policy (last pressed wins, cancel to neutral,
+    or first pressed wins); the circular gate pulls diagonals back onto the unit circle like a
+    real stick, and cap limits the deflection (walk modifier). Positions are run through the
+    inverse of the stick curve so the deflection, not the ramp position, is what gets scaled.
+    """
+    if policy not in SOCD_POLICIES:
+        raise ValueError(f"LEFT_STICK_SOCD must be one of {', '.join(SOCD_POLICIES)}, not '{policy}'")
+    if gate not in STICK_GATES:
+        raise ValueError(f"LEFT_STICK_GATE must be one of {', '.join(STICK_GATES)}, not '{gate}'")
+
+    def resolve(pos, neg, pos_was_last):
+        if pos and neg:
+            if policy == 'neutral':
+                return 0
+            return 1 if bool(pos_was_last) == (policy == 'last') else -1
+        return 1 if pos else -1 if neg else 0
+
+    table = []
+    for index in range(64):
+        bits, order = index & 15, index >> 4
+        dx = resolve(bits & STICK_X_POS, bits & STICK_X_NEG, order & 1)
+        dy = resolve(bits & STICK_Y_POS, bits & STICK_Y_NEG, order & 2)
+        scale = cap * (math.sqrt(0.5) if gate == 'circle' and dx and dy else 1.0)
+        position = scale ** (1.0 / exponent)
+        table.append((dx * position, dy * position))
+    return table
+
+def build_stick_curve(exponent):
+    """Stick response curve: ramp position (0..RAMP_STEPS-1) -> (deflection above, below centre)."""
+    last = RAMP_STEPS - 1
+    up, down = STICK_MAX - STICK_CENTER, STICK_CENTER - STICK_MIN
+    return [(round(up * (i / last) ** exponent), round(down * (i / last) ** exponent))
+            for i in range(RAMP_STEPS)]
+
+# Keys driving an analog trigger: keymap entry -> index into trigger_ramps
+TRIGGER_KEY_OUTPUTS = {
+    'LEFT_TRIGGER_KEY': 0,
+    'RIGHT_TRIGGER_KEY': 1,
+}
+
+# Mouse sources that MOUSE_<source>=<target> entries can route. Buttons are held like
+# keys; wheel notches become timed press/release pulses of their target.
+MOUSE_BUTTON_SOURCES = ('BTN_LEFT', 'BTN_RIGHT', 'BTN_MIDDLE', 'BTN_SIDE', 'BTN_EXTRA')
+MOUSE_WHEEL_SOURCES = {
+    'WHEEL_UP': (evdev.ecodes.REL_WHEEL, 1),
+    'WHEEL_DOWN': (evdev.ecodes.REL_WHEEL, -1),
+    'WHEEL_RIGHT': (evdev.ecodes.REL_HWHEEL, 1),
+    'WHEEL_LEFT': (evdev.ecodes.REL_HWHEEL, -1),
+}
+MOUSE_ENTRIES = tuple(f'MOUSE_{src}' for src in (*MOUSE_BUTTON_SOURCES, *MOUSE_WHEEL_SOURCES))
+
+def mouse_target(name):
+    """Compiled form of a mouse binding target: ('button', uinput event) or ('trigger', ramp index)."""
+    if name in BUTTON_OUTPUTS:
+        return ('button', BUTTON_OUTPUTS[name])
+    if name == 'LEFT_TRIGGER':
+        return ('trigger', 0)
+    if name == 'RIGHT_TRIGGER':
+        return ('trigger', 1)
+    return None
+
+def build_keymap(raw_map):
+    """Merge a raw config dict over DEFAULT_KEYMAP, handling the dual-key axis entries."""
+    def get_key(k, default=None):
+        return raw_map.get(k, default)
+
+    # For axis keys, split comma separated keys
+    # Left Stick X
+    xs = get_key('ABS_LEFT_STICK_X', None)
+    if xs and ',' in xs:
+        pos_key, neg_key = [k.strip() for k in xs.split(',',1)]
+    else:
+        pos_key = get_key('ABS_LEFT_STICK_X_POS', DEFAULT_KEYMAP['ABS_LEFT_STICK_X_POS'])
+        neg_key = get_key('ABS_LEFT_STICK_X_NEG', DEFAULT_KEYMAP['ABS_LEFT_STICK_X_NEG'])
+    # Left Stick Y
+    ys = get_key('ABS_LEFT_STICK_Y', None)
+    if ys and ',' in ys:
+        posy_key, negy_key = [k.strip() for k in ys.split(',',1)]
+    else:
+        posy_key = get_key('ABS_LEFT_STICK_Y_POS', DEFAULT_KEYMAP['ABS_LEFT_STICK_Y_POS'])
+        negy_key = get_key('ABS_LEFT_STICK_Y_NEG', DEFAULT_KEYMAP['ABS_LEFT_STICK_Y_NEG'])
+
+    keymap = {name: get_key(name, DEFAULT_KEYMAP[name]) for name in (*BUTTON_OUTPUTS, *TRIGGER_KEY_OUTPUTS)}
+    keymap.update({
+        'ABS_LEFT_STICK_X_POS': pos_key,
+        'ABS_LEFT_STICK_X_NEG': neg_key,
+        'ABS_LEFT_STICK_Y_POS': posy_key,
+        'ABS_LEFT_STICK_Y_NEG': negy_key,
+        # Older config files spell these RIGHT_TRIGGER_MOUSE_LEFT / LEFT_TRIGGER_MOUSE_MIDDLE
+        'RIGHT_TRIGGER_MOUSE': get_key('RIGHT_TRIGGER_MOUSE', get_key('RIGHT_TRIGGER_MOUSE_LEFT',
+                                                                      DEFAULT_KEYMAP['RIGHT_TRIGGER_MOUSE'])),
+        'LEFT_TRIGGER_MOUSE': get_key('LEFT_TRIGGER_MOUSE', get_key('LEFT_TRIGGER_MOUSE_MIDDLE',
+                                                                    DEFAULT_KEYMAP['LEFT_TRIGGER_MOUSE'])),
+    })
+    # Mouse routing: the trigger shorthands first, explicit MOUSE_ entries win
+    for entry in MOUSE_ENTRIES:
+        keymap[entry] = None
+    for shorthand, target in (('RIGHT_TRIGGER_MOUSE', 'RIGHT_TRIGGER'), ('LEFT_TRIGGER_MOUSE', 'LEFT_TRIGGER')):
+        entry = f'MOUSE_{keymap[shorthand]}'
+        if entry in keymap:
+            keymap[entry] = target
+    for entry in MOUSE_ENTRIES:
+        keymap[entry] = get_key(entry, keymap[entry])
+    return keymap
+
+def resolve_code(name):
+    """Turn a name like 'KEY_SPACE' into its evdev code (ints are passed through), None if unknown."""
+    if isinstance(name, int):
+        return name
+    if not name.startswith(('KEY_', 'BTN_')):
+        return None
+    return evdev.ecodes.ecodes.get(name)
+
+# Script hotkeys as seen by bindings: V is swallowed before dispatch, N/M/H fire alongside it.
+# The emergency combo and Shift+Alt chords are not listed, they only trigger with modifiers.
+CONSUMED_HOTKEYS = {evdev.ecodes.KEY_V: 'V (cycle sensitivity)'}
+SHARED_HOTKEYS = {
+    evdev.ecodes.KEY_N: 'N (cursor lock)',
+    evdev.ecodes.KEY_M: 'M (mouse smoothing)',
+    evdev.ecodes.KEY_H: 'H (help)',
+}
+# Shift + Alt + 1..9 selects a profile, Shift + Alt + D dumps the flight recorder; with the
+# modifiers held these keys press nothing else
+PROFILE_HOTKEYS = {getattr(evdev.ecodes, f'KEY_{n}'): n - 1 for n in range(1, 10)}
+FLIGHT_DUMP_HOTKEY = evdev.ecodes.KEY_D
+CHORD_HOTKEYS = {code: f'Shift+Alt+{n + 1} (profile)' for code, n in PROFILE_HOTKEYS.items()}
+CHORD_HOTKEYS[FLIGHT_DUMP_HOTKEY] = 'Shift+Alt+D (flight recorder dump)'
+PROFILE_SETTINGS = ('SENSITIVITY_LEVELS', 'SENSITIVITY', 'SMOOTHING', 'SMOOTHING_MS', 'SMOOTHING_SIZE',
+                    'CENTERING', 'CENTER_TARGET', 'GRAB', 'WM_CLASS',
+                    'TRIGGER_ATTACK_MS', 'TRIGGER_RELEASE_MS', 'TRIGGER_CURVE', 'TRIGGER_MAX',
+                    'TRIGGER_WHEEL_STEP', 'WHEEL_PULSE_MS', 'LEFT_STICK_SOCD', 'LEFT_STICK_GATE',
+                    'LEFT_STICK_RAMP_MS', 'LEFT_STICK_CURVE', 'LEFT_STICK_WALK_KEY',
+                    'LEFT_STICK_WALK_FRACTION', 'RIGHT_STICK_MODE', 'FLICK_TURN_RATE',
+                    'FLICK_DEGREES_PER_COUNT', 'FLICK_DEADZONE', 'FLICK_CURVE', 'REGION_SIZE',
+                    'REGION_CURVE') + tuple(name + '_RAMP_MS' for name in AXIS_OUTPUTS) + \
+                   tuple('TURBO_' + name for name in BUTTON_OUTPUTS)
+KNOWN_CONFIG_ENTRIES = (set(BUTTON_OUTPUTS) | set(AXIS_OUTPUTS) | set(TRIGGER_KEY_OUTPUTS) |
+                        set(MOUSE_ENTRIES) | set(PROFILE_SETTINGS) |
+                        {'ABS_LEFT_STICK_X', 'ABS_LEFT_STICK_Y', 'RIGHT_TRIGGER_MOUSE', 'LEFT_TRIGGER_MOUSE',
+                         'RIGHT_TRIGGER_MOUSE_LEFT', 'LEFT_TRIGGER_MOUSE_MIDDLE'})
+
+def validate_keymap(raw_map, keymap):
+    """Resolve every binding up front; returns the unknown, shadowed and conflicting ones, and
+    notes on keys that are also a Shift+Alt hotkey (not problems, --strict-keymap allows them)."""
+    layers = parse_layers(raw_map)
+    notes = []
+    problems = [f"{entry}: unknown config entry, ignored" for entry in raw_map
+                if entry not in KNOWN_CONFIG_ENTRIES and ':' not in entry
+                and not entry.startswith(('MACRO_', 'LAYER_'))]
+    tables = {'button': BUTTON_OUTPUTS, 'axis': AXIS_OUTPUTS, 'trigger': TRIGGER_KEY_OUTPUTS}
+    owners = {}  # (table, code) -> entry that wins the key in that table
+    for table, entries in tables.items():
+        for entry in entries:
+            keyname = keymap[entry]
+            if keyname is None:
+                continue  # optional binding left unset
+            code = resolve_code(keyname)
+            if code is None:
+                problems.append(f"{entry}={keyname}: unknown key name, binding ignored")
+                continue
+            if code in CONSUMED_HOTKEYS:
+                problems.append(f"{entry}={keyname}: taken by the {CONSUMED_HOTKEYS[code]} hotkey, can never fire")
+            elif code in SHARED_HOTKEYS:
+                problems.append(f"{entry}={keyname}: also triggers the {SHARED_HOTKEYS[code]} hotkey")
+            elif code in CHORD_HOTKEYS:
+                notes.append(f"{entry}={keyname}: with Shift+Alt held it is the {CHORD_HOTKEYS[code]} "
+                             f"hotkey instead")
+            winner = owners.get((table, code))
+            if winner is not None:
+                problems.append(f"{entry}={keyname}: shadowed by {winner}={keyname}, can never fire")
+                continue
+            owners[(table, code)] = entry
+            for other_table in tables:
+                other = owners.get((other_table, code))
+                if other_table != table and other is not None:
+                    problems.append(f"{entry}={keyname}: same key also drives {other}")
+    for shorthand in ('RIGHT_TRIGGER_MOUSE', 'LEFT_TRIGGER_MOUSE'):
+        if keymap[shorthand] not in MOUSE_BUTTON_SOURCES:
+            problems.append(f"{shorthand}={keymap[shorthand]}: not a mouse button "
+                            f"({', '.join(MOUSE_BUTTON_SOURCES)}), ignored")
+    for entry in MOUSE_ENTRIES:
+        if keymap[entry] is not None and mouse_target(keymap[entry]) is None:
+            problems.append(f"{entry}={keymap[entry]}: unknown target, use a controller button "
+                            f"name or LEFT_TRIGGER/RIGHT_TRIGGER")
+    for entry in raw_map:
+        if not entry.startswith('MACRO_'):
+            continue
+        keyname = entry[len('MACRO_'):]
+        code = resolve_code(keyname)
+        if code is None:
+            problems.append(f"{entry}: unknown key name '{keyname}', macro ignored")
+        elif code in CONSUMED_HOTKEYS:
+            problems.append(f"{entry}: taken by the {CONSUMED_HOTKEYS[code]} hotkey, can never fire")
         else:
-            posy_key = get_key('ABS_LEFT_STICK_Y_POS', DEFAULT_KEYMAP['ABS_LEFT_STICK_Y_POS'])
-            negy_key = get_key('ABS_LEFT_STICK_Y_NEG', DEFAULT_KEYMAP['ABS_LEFT_STICK_Y_NEG'])
-
-        loaded_keymap = {
-            'BTN_A': get_key('BTN_A', DEFAULT_KEYMAP['BTN_A']),
-            'BTN_B': get_key('BTN_B', DEFAULT_KEYMAP['BTN_B']),
-            'BTN_X': get_key('BTN_X', DEFAULT_KEYMAP['BTN_X']),
-            'BTN_Y': get_key('BTN_Y', DEFAULT_KEYMAP['BTN_Y']),
-            'BTN_THUMBL': get_key('BTN_THUMBL', DEFAULT_KEYMAP['BTN_THUMBL']),
-            'BTN_THUMBR': get_key('BTN_THUMBR', DEFAULT_KEYMAP['BTN_THUMBR']),
-            'BTN_TL': get_key('BTN_TL', DEFAULT_KEYMAP['BTN_TL']),
-            'BTN_TR': get_key('BTN_TR', DEFAULT_KEYMAP['BTN_TR']),
-            'BTN_TL2': get_key('BTN_TL2', DEFAULT_KEYMAP['BTN_TL2']),
-            'BTN_TR2': get_key('BTN_TR2', DEFAULT_KEYMAP['BTN_TR2']),
-            'BTN_START': get_key('BTN_START', DEFAULT_KEYMAP['BTN_START']),
-            'BTN_SELECT': get_key('BTN_SELECT', DEFAULT_KEYMAP['BTN_SELECT']),
-            'BTN_MODE': get_key('BTN_MODE', DEFAULT_KEYMAP['BTN_MODE']),
-            'BTN_DPAD_UP': get_key('BTN_DPAD_UP', DEFAULT_KEYMAP['BTN_DPAD_UP']),
-            'BTN_DPAD_DOWN': get_key('BTN_DPAD_DOWN', DEFAULT_KEYMAP['BTN_DPAD_DOWN']),
-            'BTN_DPAD_LEFT': get_key('BTN_DPAD_LEFT', DEFAULT_KEYMAP['BTN_DPAD_LEFT']),
-            'BTN_DPAD_RIGHT': get_key('BTN_DPAD_RIGHT', DEFAULT_KEYMAP['BTN_DPAD_RIGHT']),
-            'ABS_LEFT_STICK_X_POS': pos_key,
-            'ABS_LEFT_STICK_X_NEG': neg_key,
-            'ABS_LEFT_STICK_Y_POS': posy_key,
-            'ABS_LEFT_STICK_Y_NEG': negy_key,
-            'RIGHT_TRIGGER_MOUSE': evdev.ecodes.BTN_LEFT,
-            'LEFT_TRIGGER_MOUSE': evdev.ecodes.BTN_MIDDLE,
-        }
-        print(f"Loaded keymap from '{CONFIG_FILENAME}': {loaded_keymap}")
-    except Exception as e:
-        print(f"Failed to load keymap config '{CONFIG_FILENAME}', using defaults. Error: {e}")
-        loaded_keymap = DEFAULT_KEYMAP.copy()
-else:
-    print(f"Config file '{CONFIG_FILENAME}' not found, using default keymap.")
-    loaded_keymap = DEFAULT_KEYMAP.copy()
+            drives = [owner for (_table, owned), owner in owners.items() if owned == code]
+            if drives:
+                problems.append(f"{entry}: same key also drives {', '.join(drives)}")
+    layer_owners = {}
+    for name, (keyname, _toggle) in layers.items():
+        code = resolve_code(keyname)
+        if code is None:
+            problems.append(f"LAYER_{name}={keyname}: unknown key name, layer ignored")
+            continue
+        if code in layer_owners:
+            problems.append(f"LAYER_{name}={keyname}: key already switches layer {layer_owners[code]}, ignored")
+            continue
+        layer_owners[code] = name
+        drives = [owner for (_table, owned), owner in owners.items() if owned == code]
+        if drives:
+            problems.append(f"LAYER_{name}={keyname}: layer key is taken over, {', '.join(drives)} can never fire")
+    for entry, value in raw_map.items():
+        layer, _, layer_entry = entry.partition(':')
+        if not layer_entry:
+            continue
+        if layer not in layers:
+            problems.append(f"{entry}: no LAYER_{layer} entry, ignored")
+        elif not (layer_entry in BUTTON_OUTPUTS or layer_entry in AXIS_OUTPUTS or
+                  layer_entry in TRIGGER_KEY_OUTPUTS or layer_entry.startswith('MACRO_')):
+            problems.append(f"{entry}: unknown config entry, ignored")
+        elif layer_binding(layer_entry, value) is None:
+            problems.append(f"{entry}={value}: unknown key name, binding ignored")
+    if int(raw_map.get('TRIGGER_WHEEL_STEP', 0)) and (keymap['MOUSE_WHEEL_UP'] or keymap['MOUSE_WHEEL_DOWN']):
+        problems.append("TRIGGER_WHEEL_STEP: the vertical wheel also adjusts trigger pressure")
+    return problems, notes
+
+def compile_keymap(keymap):
+    """Resolve a name-based keymap into integer-keyed dispatch tables for the input loop.
+
+    Bindings validate_keymap() complained about are dropped or lose to the earlier entry.
+    """
+    buttons = {}
+    for name, output in BUTTON_OUTPUTS.items():
+        code = resolve_code(keymap[name])
+        if code is not None and code not in buttons:
+            buttons[code] = output
+    axes = {}
+    for name, target in AXIS_OUTPUTS.items():
+        code = resolve_code(keymap[name])
+        if code is not None and code not in axes:
+            axes[code] = target
+    trigger_keys = {}
+    for name, index in TRIGGER_KEY_OUTPUTS.items():
+        code = resolve_code(keymap[name]) if keymap[name] is not None else None
+        if code is not None and code not in trigger_keys:
+            trigger_keys[code] = index
+    mouse_buttons = {}
+    for src in MOUSE_BUTTON_SOURCES:
+        target = mouse_target(keymap[f'MOUSE_{src}'])
+        if target is not None:
+            mouse_buttons[resolve_code(src)] = target
+    wheel = {}
+    for src, axis_direction in MOUSE_WHEEL_SOURCES.items():
+        target = mouse_target(keymap[f'MOUSE_{src}'])
+        if target is not None:
+            wheel[axis_direction] = target
+    return {
+        'buttons': buttons,
+        'axes': axes,
+        'trigger_keys': trigger_keys,
+        'mouse_buttons': mouse_buttons,
+        'wheel': wheel,
+    }
+
+# Shift layers: LAYER_<name>=<key>[,hold|toggle] declares a layer, <name>:<entry>=<key> binds
+# on it. A layer's tables are the base ones with the keys it rebinds taken over, so switching
+# layers is a single reference swap in the input loop.
+LAYER_TABLES = ('buttons', 'axes', 'trigger_keys', 'macros')
+
+def parse_layers(raw_map):
+    """LAYER_ entries -> {name: (key name, toggle)}, in file order."""
+    layers = {}
+    for entry, value in raw_map.items():
+        if entry.startswith('LAYER_'):
+            fields = [field.strip() for field in value.split(',')]
+            toggle = len(fields) > 1 and fields[1].lower() == 'toggle'
+            layers[entry[len('LAYER_'):]] = (fields[0], toggle)
+    return layers
+
+def layer_binding(entry, value):
+    """One <name>:<entry> value -> (table, key code, output), or None if it can't be resolved."""
+    if entry.startswith('MACRO_'):
+        code = resolve_code(entry[len('MACRO_'):])
+        return None if code is None else ('macros', code, compile_macro(value))
+    code = resolve_code(value)
+    if code is None:
+        return None
+    if entry in BUTTON_OUTPUTS:
+        return 'buttons', code, BUTTON_OUTPUTS[entry]
+    if entry in AXIS_OUTPUTS:
+        return 'axes', code, AXIS_OUTPUTS[entry]
+    if entry in TRIGGER_KEY_OUTPUTS:
+        return 'trigger_keys', code, TRIGGER_KEY_OUTPUTS[entry]
+    return None
+
+def compile_layers(raw_map, base):
+    """Build every layer's dispatch tables over the base ones; fills base['layer_keys']."""
+    layer_keys = {}  # layer key code -> (index into the returned list, toggle)
+    tables = []
+    for name, (keyname, toggle) in parse_layers(raw_map).items():
+        code = resolve_code(keyname)
+        if code is None or code in layer_keys:
+            continue  # reported by validate_keymap()
+        table = dict(base)
+        for table_name in LAYER_TABLES:
+            table[table_name] = dict(base[table_name])
+        taken = set()
+        for entry, value in raw_map.items():
+            layer, _, layer_entry = entry.partition(':')
+            binding = layer_binding(layer_entry, value) if layer == name and layer_entry else None
+            if binding is None or binding[1] in taken:
+                continue
+            table_name, key, output = binding
+            taken.add(key)
+            for other in LAYER_TABLES:
+                table[other].pop(key, None)
+            table[table_name][key] = output
+        layer_keys[code] = (len(tables), toggle)
+        tables.append(table)
+    base['layer_keys'] = layer_keys
+    for table in tables:
+        table['layer_keys'] = layer_keys
+    return tables
 
 # Construct device_events with known uinput codes (same as before):
 device_events = (
@@ -176,51 +633,721 @@ device_events = (
     uinput.BTN_THUMBL,
     uinput.BTN_THUMBR,
     uinput.BTN_MODE,
-    uinput.ABS_X + (0, 255, 0, 0),
-    uinput.ABS_Y + (0, 255, 0, 0),
-    uinput.ABS_RX + (0, 255, 0, 0),
-    uinput.ABS_RY + (0, 255, 0, 0),
-    uinput.ABS_Z + (0, 255, 0, 0),
-    uinput.ABS_RZ + (0, 255, 0, 0),
+    uinput.ABS_X + (STICK_MIN, STICK_MAX, 0, 0),
+    uinput.ABS_Y + (STICK_MIN, STICK_MAX, 0, 0),
+    uinput.ABS_RX + (STICK_MIN, STICK_MAX, 0, 0),
+    uinput.ABS_RY + (STICK_MIN, STICK_MAX, 0, 0),
+    uinput.ABS_Z + (0, TRIGGER_FULL, 0, 0),
+    uinput.ABS_RZ + (0, TRIGGER_FULL, 0, 0),
     uinput.BTN_DPAD_UP, uinput.BTN_DPAD_DOWN,
     uinput.BTN_DPAD_LEFT, uinput.BTN_DPAD_RIGHT,
 )
 
-device = uinput.Device(device_events, name="Virtual Xbox Controller")
-
-left_x, left_y = 128, 128
-right_x, right_y = 128, 128
-left_trigger = 0
-right_trigger = 0
+# Metrics: plain integers bumped where things happen; only a scrape (see metrics_thread)
+# turns them into totals, rates and histogram buckets
+counters = {'writes': 0, 'frames_written': 0, 'suppressed_batches': 0, 'autorepeat_dropped': 0}
+# X requests that waited for a reply, one entry per X connection so that each is only ever
+# bumped by the thread owning that connection and no increment can be lost
+x_round_trips = {'worker': 0, 'focus': 0}
+events_read = {keyboard.fd: 0, mouse.fd: 0}  # device fd -> events read from it
+hotkey_hits = dict.fromkeys(['sensitivity', 'profile', 'cursor_lock', 'centering', 'smoothing', 'help',
+                             'flight_dump', 'emergency'], 0)
+# Input-to-write latency: kernel timestamp of the last event of a batch to the syn it caused
+LATENCY_BOUNDS = (0.00025, 0.0005, 0.001, 0.002, 0.004, 0.008, 0.016, 0.032)
+latency_buckets = [0] * (len(LATENCY_BOUNDS) + 1)  # the last one is +Inf
+latency_sum = 0.0
+batch_time = 0.0
+
+def observe_latency():
+    global latency_sum
+    latency = time.time() - batch_time
+    latency_buckets[bisect.bisect_left(LATENCY_BOUNDS, latency)] += 1
+    latency_sum += latency
+
+# Flight recorder: the last N input events and output writes in a preallocated ring, so that
+# recording is a pack_into and an index bump. It is dumped (oldest first) on the emergency
+# combo, Shift+Alt+D, SIGUSR1 or an uncaught exception; flight_reader.py decodes the dumps.
+FLIGHT_MAGIC = b'WHISKFR1'
+FLIGHT_HEADER = struct.Struct('<8sHIQ')  # magic, record size, records in file, records ever made
+FLIGHT_RECORD = struct.Struct('<dBxHHi')  # time (s, CLOCK_REALTIME like evdev), source, type, code, value
+SOURCE_KEYBOARD, SOURCE_MOUSE, SOURCE_OUTPUT = 0, 1, 2
+
+class FlightRecorder:
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.buffer = bytearray(self.size * FLIGHT_RECORD.size)
+        self.total = 0
+
+    def record(self, t, source, etype, code, value):
+        FLIGHT_RECORD.pack_into(self.buffer, self.total % self.size * FLIGHT_RECORD.size,
+                                t, source, etype, code, value)
+        self.total += 1
+
+    def snapshot(self):
+        total = self.total
+        if total <= self.size:
+            return total, bytes(self.buffer[:total * FLIGHT_RECORD.size])
+        split = total % self.size * FLIGHT_RECORD.size
+        return total, bytes(self.buffer[split:]) + bytes(self.buffer[:split])
+
+    def dump(self, reason):
+        """Copy the ring now; the file is written by a thread of its own, off the input path.
+        That thread is not a daemon, so a dump taken on the way out still completes."""
+        total, data = self.snapshot()
+        path = os.path.join(args.flight_dir, f"whisk-flight-{time.strftime('%Y%m%d-%H%M%S')}-{reason}.bin")
+        threading.Thread(target=self.write, args=(path, total, data)).start()
+
+    def write(self, path, total, data):
+        count = len(data) // FLIGHT_RECORD.size
+        try:
+            with open(path, 'wb') as f:
+                f.write(FLIGHT_HEADER.pack(FLIGHT_MAGIC, FLIGHT_RECORD.size, count, total))
+                f.write(data)
+        except OSError as e:
+            log(f"Flight recorder dump failed: {e}", WARNING)
+            return
+        log(f"Flight recorder: last {count} events written to '{path}'.")
+
+flight_recorder = FlightRecorder(args.flight_records)
+
+class RecordingDevice:
+    """The uinput device, with every write also noted in the flight recorder."""
+    def __init__(self, device):
+        self.device = device
+
+    def emit(self, event, value, syn=True):
+        t = time.time()
+        flight_recorder.record(t, SOURCE_OUTPUT, event[0], event[1], value)
+        counters['writes'] += 1
+        if syn:
+            flight_recorder.record(t, SOURCE_OUTPUT, EV_SYN, SYN_REPORT, 0)
+            counters['frames_written'] += 1
+        self.device.emit(event, value, syn=syn)
+
+    def syn(self):
+        flight_recorder.record(time.time(), SOURCE_OUTPUT, EV_SYN, SYN_REPORT, 0)
+        counters['frames_written'] += 1
+        self.device.syn()
+
+device = RecordingDevice(uinput.Device(device_events, name="Virtual Xbox Controller"))
+
+left_stick = [STICK_CENTER, STICK_CENTER]  # X, Y
+left_stick_bits = 0   # STICK_* directions currently held
+left_stick_order = 0  # which direction of each axis was pressed last, see STICK_ORDER_ON_PRESS
+right_x, right_y = float(STICK_CENTER), float(STICK_CENTER)  # fractions carry over between reports
 
 def clamp(v):
     return max(0, min(255, v))
 
+# Timers run inside input_thread: select() sleeps until the earliest deadline, so an
+# empty heap costs nothing and a due timer fires on time however busy the input is.
+timers = []  # heap of (deadline, seq, callback(now))
+timer_seq = itertools.count()
+
+def schedule(deadline, callback):
+    heapq.heappush(timers, (deadline, next(timer_seq), callback))
+
+def run_due_timers(now):
+    while timers and timers[0][0] <= now:
+        _deadline, _seq, callback = heapq.heappop(timers)
+        callback(now)
+
+RAMP_TICK = 0.001  # seconds between trigger ramp updates (1 kHz)
+RAMP_STEPS = 1024
+
+def build_curve_table(exponent):
+    """Trigger response curve: ramp position (0..RAMP_STEPS-1) -> pressure 0..TRIGGER_FULL."""
+    last = RAMP_STEPS - 1
+    return [round(TRIGGER_FULL * (i / last) ** exponent) for i in range(RAMP_STEPS)]
+
+class TriggerRamp:
+    """Analog trigger that moves towards fully pressed/released over the configured times.
+
+    The position is integrated from real elapsed time, so tick jitter never changes the
+    ramp duration. Ticks are only scheduled while the trigger is actually moving.
+    """
+    def __init__(self, abs_event):
+        self.abs_event = abs_event
+        self.holders = 0  # mouse buttons and keys currently holding it
+        self.position = 0.0
+        self.direction = 0
+        self.last_time = 0.0
+        self.value = 0
+        self.ticking = False
+    def configure(self, settings):
+        self.attack_rate = 1000.0 / settings['attack_ms'] if settings['attack_ms'] > 0 else None
+        self.release_rate = 1000.0 / settings['release_ms'] if settings['release_ms'] > 0 else None
+        self.curve = settings['curve']
+        self.max_value = settings['max']
+        self.wheel_step = settings['wheel_step']
+    def press(self, now):
+        self.holders += 1
+        if self.holders == 1:
+            self._set_direction(1, now)
+    def release(self, now):
+        if self.holders == 0:
+            return
+        self.holders -= 1
+        if self.holders == 0:
+            self._set_direction(-1, now)
+    def adjust_max(self, notches):
+        """Mouse wheel pressure adjustment; applies to the current position right away."""
+        self.max_value = max(self.wheel_step, min(255, self.max_value + notches * self.wheel_step))
+        self._output()
+    def reset(self):
+        """Drop to zero at once (caller sends the syn)."""
+        self.holders = 0
+        self.position = 0.0
+        self.direction = 0
+        self._output()
+    def tick(self, now):
+        self.ticking = False
+        self._integrate(now)
+        self._output()
+        self._schedule(now)
+    def _set_direction(self, direction, now):
+        self._integrate(now)
+        self.direction = direction
+        self._integrate(now)  # an instant (0 ms) ramp jumps straight to its end
+        self._output()
+        self._schedule(now)
+    def _integrate(self, now):
+        elapsed = now - self.last_time
+        self.last_time = now
+        if self.direction > 0:
+            rate = self.attack_rate
+            self.position = 1.0 if rate is None else min(1.0, self.position + elapsed * rate)
+            if self.position >= 1.0:
+                self.direction = 0
+        elif self.direction < 0:
+            rate = self.release_rate
+            self.position = 0.0 if rate is None else max(0.0, self.position - elapsed * rate)
+            if self.position <= 0.0:
+                self.direction = 0
+    def _schedule(self, now):
+        if self.direction != 0 and not self.ticking:
+            self.ticking = True
+            schedule(now + RAMP_TICK, self.tick)
+    def _output(self):
+        value = self.curve[int(self.position * (RAMP_STEPS - 1))] * self.max_value // 255
+        if value != self.value:
+            self.value = value
+            device.emit(self.abs_event, value, syn=False)
+
+trigger_ramps = [TriggerRamp(uinput.ABS_Z), TriggerRamp(uinput.ABS_RZ)]  # left, right
+
+class StickRamp:
+    """One left stick axis gliding towards the target the held keys resolve to.
+
+    Moving out uses the ramp time of the binding pointing that way, moving back to the
+    centre the ramp time of the side it is on; 0 ms jumps at once. Like TriggerRamp it
+    integrates real elapsed time and only ticks while moving.
+    """
+    def __init__(self, index, abs_event, pos_bit, neg_bit):
+        self.index = index  # into left_stick
+        self.abs_event = abs_event
+        self.pos_bit = pos_bit
+        self.neg_bit = neg_bit
+        self.position = 0.0
+        self.target = 0.0
+        self.last_time = 0.0
+        self.ticking = False
+    def configure(self, rates, curve):
+        """rates: STICK_* bit -> ramp positions per second (None = instant)."""
+        self.pos_rate = rates[self.pos_bit]
+        self.neg_rate = rates[self.neg_bit]
+        self.curve = curve
+    def set_target(self, target, now):
+        if target == self.target:
+            return
+        self._integrate(now)
+        self.target = target
+        self._integrate(now)
+        self._output()
+        self._schedule(now)
+    def reset(self):
+        """Snap back to the centre at once (caller sends the syn)."""
+        self.position = self.target = 0.0
+        self._output()
+    def tick(self, now):
+        self.ticking = False
+        self._integrate(now)
+        self._output()
+        self._schedule(now)
+    def _integrate(self, now):
+        elapsed = now - self.last_time
+        self.last_time = now
+        position, target = self.position, self.target
+        if position == target:
+            return
+        side = target if target != 0.0 else position
+        rate = self.pos_rate if side > 0 else self.neg_rate
+        if rate is None:
+            self.position = target
+        elif position < target:
+            self.position = min(target, position + elapsed * rate)
+        else:
+            self.position = max(target, position - elapsed * rate)
+    def _schedule(self, now):
+        if self.position != self.target and not self.ticking:
+            self.ticking = True
+            schedule(now + RAMP_TICK, self.tick)
+    def _output(self):
+        position = self.position
+        if position >= 0.0:
+            value = STICK_CENTER + self.curve[int(position * (RAMP_STEPS - 1))][0]
+        else:
+            value = STICK_CENTER - self.curve[int(-position * (RAMP_STEPS - 1))][1]
+        if value != left_stick[self.index]:
+            left_stick[self.index] = value
+            device.emit(self.abs_event, value, syn=False)
+
+stick_ramps = [StickRamp(0, uinput.ABS_X, STICK_X_POS, STICK_X_NEG),
+               StickRamp(1, uinput.ABS_Y, STICK_Y_POS, STICK_Y_NEG)]
+
+# Right stick aiming modes besides plain mouse delta. Both collect mouse motion as it arrives
+# and write the stick from a fixed 1 kHz tick that only runs while there is something to do.
+AIM_TICK = 0.001
+RIGHT_STICK_MODES = ('delta', 'flick', 'region')
+
+def build_flick_table(deadzone, exponent):
+    """Turn speed wanted (0..RAMP_STEPS-1 of the full rate) -> stick deflection (above, below centre).
+
+    Inverts the game's response: its deadzone is skipped and its curve exponent undone, so the
+    camera turns at the fraction asked for.
+    """
+    last = RAMP_STEPS - 1
+    up, down = STICK_MAX - STICK_CENTER, STICK_CENTER - STICK_MIN
+    table = [(0, 0)]
+    for i in range(1, RAMP_STEPS):
+        deflection = deadzone + (1.0 - deadzone) * (i / last) ** (1.0 / exponent)
+        table.append((round(up * deflection), round(down * deflection)))
+    return table
+
+def stick_value(table, fraction):
+    """-1..1 through a (above, below centre) table -> device value."""
+    if fraction >= 0.0:
+        return STICK_CENTER + table[int(min(fraction, 1.0) * (RAMP_STEPS - 1))][0]
+    return STICK_CENTER - table[int(min(-fraction, 1.0) * (RAMP_STEPS - 1))][1]
+
+class FlickStick:
+    """Mouse X becomes camera rotation: the stick is held over as long as the game needs, at its
+    calibrated full-deflection turn rate, to turn by the angle the mouse moved. Mouse Y keeps
+    the usual delta mapping."""
+    def __init__(self):
+        self.pending = 0.0  # degrees still to turn
+        self.value = STICK_CENTER
+        self.ticking = False
+    def configure(self, settings):
+        # Deltas arrive scaled by the sensitivity level and STICK_UNIT
+        self.degrees_per_unit = settings['flick_degrees_per_count'] / STICK_UNIT
+        self.step = settings['flick_turn_rate'] * AIM_TICK  # degrees one tick turns at full deflection
+        self.table = settings['flick_table']
+    def motion(self, dx, dy, now):
+        self.pending += dx * self.degrees_per_unit
+        if not self.ticking:
+            self.ticking = True
+            schedule(now + AIM_TICK, self.tick)
+        return dy
+    def reset(self):
+        self.pending = 0.0
+        self._output(STICK_CENTER)
+    def tick(self, now):
+        if abs(self.pending) * RAMP_STEPS < self.step:
+            # Less than the table's smallest turn: keep it for the next motion and go idle
+            self._output(STICK_CENTER)
+            self.ticking = False
+            return
+        fraction = max(-1.0, min(1.0, self.pending / self.step))
+        self.pending -= fraction * self.step
+        self._output(stick_value(self.table, fraction))
+        schedule(now + AIM_TICK, self.tick)
+    def _output(self, value):
+        if value != self.value:
+            self.value = value
+            device.emit(uinput.ABS_RX, value, syn=False)
+
+class RegionStick:
+    """A virtual pointer, moved by the mouse inside a width x height region (mouse counts),
+    whose offset from the region's centre is the stick deflection."""
+    def __init__(self):
+        self.x = self.y = 0.0
+        self.values = (STICK_CENTER, STICK_CENTER)
+        self.ticking = False
+    def configure(self, settings):
+        self.half_width = settings['region_width'] * STICK_UNIT / 2
+        self.half_height = settings['region_height'] * STICK_UNIT / 2
+        self.table = settings['region_table']
+    def motion(self, dx, dy, now):
+        self.x = max(-self.half_width, min(self.half_width, self.x + dx))
+        self.y = max(-self.half_height, min(self.half_height, self.y + dy))
+        if not self.ticking:
+            self.ticking = True
+            schedule(now + AIM_TICK, self.tick)
+        return 0
+    def reset(self):
+        self.x = self.y = 0.0
+        self._output(STICK_CENTER, STICK_CENTER)
+    def tick(self, now):
+        # Pointer moves between ticks are coalesced; the next one re-arms the tick
+        self.ticking = False
+        self._output(stick_value(self.table, self.x / self.half_width),
+                     stick_value(self.table, self.y / self.half_height))
+    def _output(self, x, y):
+        if x != self.values[0]:
+            device.emit(uinput.ABS_RX, x, syn=False)
+        if y != self.values[1]:
+            device.emit(uinput.ABS_RY, y, syn=False)
+        self.values = (x, y)
+
+aim_modes = {'flick': FlickStick(), 'region': RegionStick()}
+right_aim = None  # the active one of aim_modes, None for plain delta
+
+def press_button(output, now):
+    """Press a controller button, or start its turbo; returns what release_held() lets go of."""
+    turbo = turbo_buttons.get(output)
+    if turbo is not None:
+        turbo.press(now)
+        return turbo
+    device.emit(output, 1, syn=False)
+    return output
+
+def press_target(target, now):
+    """Press a compiled mouse target; returns what release_held() needs to let go of it."""
+    kind, value = target
+    if kind == 'button':
+        return press_button(value, now)
+    ramp = trigger_ramps[value]
+    ramp.press(now)
+    return ramp
+
+def release_held(held, now):
+    if isinstance(held, (TriggerRamp, TurboButton)):
+        held.release(now)
+    else:
+        device.emit(held, 0, syn=False)
+
+wheel_pulse_time = 0.04  # seconds a wheel notch holds its target, and the gap between pulses
+WHEEL_MAX_PENDING = 8    # notches queued beyond this are dropped
+
+class WheelPulser:
+    """Turns wheel notches in one direction into press/release pulses of the bound target."""
+    def __init__(self):
+        self.pending = 0
+        self.held = None
+        self.busy = False  # a press or the gap after it is in progress
+        self.generation = 0  # bumped by reset() so stale timers do nothing
+    def notch(self, target, count, now):
+        self.target = target
+        self.pending = min(WHEEL_MAX_PENDING, self.pending + count)
+        if not self.busy:
+            self._press(now)
+    def reset(self, now):
+        if self.held is not None:
+            release_held(self.held, now)
+        self.held = None
+        self.pending = 0
+        self.busy = False
+        self.generation += 1
+    def _press(self, now):
+        if self.pending == 0:
+            self.busy = False
+            return
+        self.pending -= 1
+        self.busy = True
+        self.held = press_target(self.target, now)
+        schedule(now + wheel_pulse_time, self._timer(self._release))
+    def _release(self, now):
+        release_held(self.held, now)
+        self.held = None
+        schedule(now + wheel_pulse_time, self._timer(self._press))
+    def _timer(self, step):
+        generation = self.generation
+        def fire(now):
+            if generation == self.generation:
+                step(now)
+        return fire
+
+wheel_pulsers = {axis_direction: WheelPulser() for axis_direction in MOUSE_WHEEL_SOURCES.values()}
+
+class JitterStat:
+    """Running count/mean/deviation/worst case of a timing error, in seconds."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.worst = 0.0
+    def add(self, error):
+        self.count += 1
+        self.total += error
+        self.squares += error * error
+        if abs(error) > abs(self.worst):
+            self.worst = error
+    def describe(self):
+        mean = self.total / self.count
+        deviation = max(0.0, self.squares / self.count - mean * mean) ** 0.5
+        return f"mean {mean * 1000:+.3f} ms, sd {deviation * 1000:.3f} ms, worst {self.worst * 1000:+.3f} ms"
+
+turbo_stats = {}  # button name -> (period JitterStat, on-time JitterStat), kept across profiles
+
+class TurboButton:
+    """Rapid-fire for one controller button: down for on_time out of every period while active.
+
+    Hold mode fires while any key bound to the button is down, toggle mode starts and stops
+    on each press. Edges are due at start + n * period, so a late timer never adds up to drift;
+    all turbo buttons share the input loop's timer heap.
+    """
+    def __init__(self, name, output, period, on_time, toggle):
+        self.output = output
+        self.period = period
+        self.on_time = on_time
+        self.toggle = toggle
+        self.holders = 0
+        self.active = False
+        self.down = False
+        self.generation = 0  # bumped on stop so stale timers do nothing
+        self.period_stat, self.on_stat = turbo_stats.setdefault(name, (JitterStat(), JitterStat()))
+    def press(self, now):
+        if self.toggle:
+            if self.active:
+                self.reset()
+            else:
+                self._start(now)
+            return
+        self.holders += 1
+        if self.holders == 1:
+            self._start(now)
+    def release(self, now):
+        if self.toggle or self.holders == 0:
+            return
+        self.holders -= 1
+        if self.holders == 0:
+            self.reset()
+    def reset(self):
+        """Stop firing and let go of the button (caller sends the syn)."""
+        self.holders = 0
+        self.active = False
+        self.generation += 1
+        if self.down:
+            self.down = False
+            device.emit(self.output, 0, syn=False)
+    def _start(self, now):
+        self.active = True
+        self.origin = now
+        self.cycle = 0
+        self.rise_time = None
+        self._rise(now)
+    def _rise(self, now):
+        if self.rise_time is not None:
+            self.period_stat.add(now - self.rise_time - self.period)
+        self.rise_time = now
+        self.down = True
+        device.emit(self.output, 1, syn=False)
+        schedule(self.origin + self.cycle * self.period + self.on_time, self._timer(self._fall))
+    def _fall(self, now):
+        self.on_stat.add(now - self.rise_time - self.on_time)
+        self.down = False
+        device.emit(self.output, 0, syn=False)
+        self.cycle += 1
+        deadline = self.origin + self.cycle * self.period
+        if deadline + self.period < now:
+            # Fell a whole cycle behind (suspend, stall): restart the grid instead of bursting
+            self.origin, self.cycle, self.rise_time = now, 0, None
+            deadline = now
+        schedule(deadline, self._timer(self._rise))
+    def _timer(self, step):
+        generation = self.generation
+        def fire(now):
+            if generation == self.generation:
+                step(now)
+        return fire
+
+turbo_buttons = {}  # uinput button -> TurboButton, for the active profile
+
+# Macros: MACRO_<key>=<ms> <control> <value>, ... plays a timed sequence when the key is
+# pressed. Controls are BUTTON_OUTPUTS names (0/1) or the axes below (0..255).
+MACRO_AXES = {
+    'ABS_X': uinput.ABS_X, 'ABS_Y': uinput.ABS_Y,
+    'ABS_RX': uinput.ABS_RX, 'ABS_RY': uinput.ABS_RY,
+    'ABS_Z': uinput.ABS_Z, 'ABS_RZ': uinput.ABS_RZ,
+}
+MACRO_NEUTRAL = {uinput.ABS_X: STICK_CENTER, uinput.ABS_Y: STICK_CENTER,
+                 uinput.ABS_RX: STICK_CENTER, uinput.ABS_RY: STICK_CENTER}
+MAX_RUNNING_MACROS = 8
+MACRO_STEPS_PER_TICK = 16  # per macro; the rest of a burst goes out on the next tick
+
+def scale_axis_value(event, value):
+    """0..255 config value -> the device's range for that axis (identity without --hires-axes)."""
+    if event not in MACRO_NEUTRAL:
+        return value * TRIGGER_FULL // 255
+    if value >= 128:
+        return STICK_CENTER + round((value - 128) * (STICK_MAX - STICK_CENTER) / 127)
+    return STICK_CENTER - round((128 - value) * (STICK_CENTER - STICK_MIN) / 128)
+
+def compile_macro(text):
+    """'0 BTN_A 1, 50 BTN_A 0' -> tuple of (offset seconds, uinput event, value), in time order."""
+    steps = []
+    for step in text.split(','):
+        fields = step.split()
+        if len(fields) != 3:
+            raise ValueError(f"macro step '{step.strip()}' should be '<ms> <control> <value>'")
+        offset, control, value = int(fields[0]), fields[1].upper(), int(fields[2])
+        event = BUTTON_OUTPUTS.get(control) or MACRO_AXES.get(control)
+        if event is None:
+            raise ValueError(f"macro step '{step.strip()}': unknown control '{fields[1]}'")
+        steps.append((offset / 1000.0, event, scale_axis_value(event, value) if control in MACRO_AXES
+                      else int(value != 0)))
+    steps.sort(key=lambda step: step[0])  # stable, so steps at the same offset keep their order
+    return tuple(steps)
+
+class MacroRunner:
+    """Plays every running macro from one timer on the shared heap.
+
+    Each tick writes the steps that are due, at most MACRO_STEPS_PER_TICK per macro, then
+    re-arms for the earliest next step. Whatever a macro leaves pressed is tracked so cancel()
+    can put it back to neutral at once.
+    """
+    def __init__(self):
+        self.running = []  # [steps, start time, next index, source key]
+        self.touched = {}  # uinput event -> neutral value, for outputs macros moved
+        self.deadline = None  # of the one armed timer; older timers see a mismatch and do nothing
+    def start(self, key, steps, now):
+        if any(macro[3] == key for macro in self.running):
+            return  # already playing
+        if len(self.running) >= MAX_RUNNING_MACROS:
+            log(f"Macro ignored: {MAX_RUNNING_MACROS} already running.", WARNING)
+            return
+        self.running.append([steps, now, 0, key])
+        self.tick(now)
+    def cancel(self):
+        """Stop every macro and neutralise what they held (caller sends the syn)."""
+        self.running.clear()
+        self.deadline = None
+        for event, value in self.touched.items():
+            self._write(event, value)
+        self.touched.clear()
+    def tick(self, now):
+        next_deadline = None
+        for macro in self.running:
+            steps, start, index, _key = macro
+            limit = index + MACRO_STEPS_PER_TICK
+            while index < len(steps) and index < limit and start + steps[index][0] <= now:
+                _offset, event, value = steps[index]
+                self._write(event, value)
+                if value == MACRO_NEUTRAL.get(event, 0):
+                    self.touched.pop(event, None)
+                else:
+                    self.touched[event] = MACRO_NEUTRAL.get(event, 0)
+                index += 1
+            macro[2] = index
+            if index < len(steps):
+                due = max(now + RAMP_TICK if index == limit else now, start + steps[index][0])
+                if next_deadline is None or due < next_deadline:
+                    next_deadline = due
+        self.running = [macro for macro in self.running if macro[2] < len(macro[0])]
+        if next_deadline is not None and next_deadline != self.deadline:
+            self.deadline = next_deadline
+            schedule(next_deadline, self._timer(next_deadline))
+    def _write(self, event, value):
+        if event == uinput.ABS_X or event == uinput.ABS_Y:
+            left_stick[event == uinput.ABS_Y] = value
+        device.emit(event, value, syn=False)
+    def _timer(self, deadline):
+        def fire(now):
+            if deadline == self.deadline:
+                self.deadline = None
+                self.tick(now)
+        return fire
+
+macro_runner = MacroRunner()
+
+def print_turbo_stats():
+    for name, (period_stat, on_stat) in turbo_stats.items():
+        if period_stat.count:
+            log(f"Turbo {name}: {period_stat.count} periods measured; period error {period_stat.describe()}; "
+                  f"on-time error {on_stat.describe()}")
+
+# Only touched from input_thread, so no lock is needed
 held_keys = set()
-held_keys_lock = threading.Lock()
-
-sensitivity_levels = [1,2,3,4,5,6,7,8,9,10]
-current_sensitivity_index = sensitivity_levels.index(5) if 5 in sensitivity_levels else 0
-current_sensitivity = sensitivity_levels[current_sensitivity_index]
-sensitivity_lock = threading.Lock()
-
-class MovingAverage:
-    def __init__(self, size=20):  # increased size for smoothing
-        self.size = size
-        self.xs = deque(maxlen=size)
-        self.ys = deque(maxlen=size)
-    def add(self, dx, dy):
-        self.xs.append(dx)
-        self.ys.append(dy)
+# Source key code -> controller button it pressed, so a release always lets go
+# of what the press actually pushed even if the keymap was swapped in between
+pressed_outputs = {}
+pressed_triggers = {}  # source key code -> TriggerRamp it is holding
+pressed_mouse = {}  # mouse button code -> uinput event or TriggerRamp it is holding
+pressed_axes = {}  # source key code -> STICK_* bit it set
+layer_stack = []  # active shift layer indices, the last one is on top
+# Focus suspension (--suspend-unfocused): profile changes while suspended only update what
+# set_suspended(False) will restore, so centering and the grab stay off until then
+suspended = False
+resume_grab = False
+resume_centering = False
+
+DEFAULT_POLL_RATE = 1000  # Hz assumed for the smoothing ring until the mouse has been measured
+POLL_RATES = (125, 250, 500, 1000, 2000, 4000, 8000)
+POLL_RATE_SAMPLES = 256  # report intervals measured before settling on a rate
+
+class WindowedAverage:
+    """Average of the mouse motion reports from the last window_ms, by the events' timestamps.
+
+    Reports sit in a preallocated ring sized for the window at the mouse's polling rate,
+    with running sums, so the cost per report is the same on a 125 Hz and an 8 kHz mouse.
+    """
+    def __init__(self, window_ms, rate_hz=DEFAULT_POLL_RATE):
+        self.window = window_ms / 1000.0
+        self.resize(rate_hz)
+    def resize(self, rate_hz):
+        # Half again as many slots as the window should hold, for polling jitter
+        self.capacity = max(1, math.ceil(self.window * rate_hz * 1.5))
+        self.times = [0.0] * self.capacity
+        self.xs = [0] * self.capacity
+        self.ys = [0] * self.capacity
+        self.clear()
+    def add(self, t, dx, dy):
+        cutoff = t - self.window
+        while self.count and (self.times[self.head] <= cutoff or self.count == self.capacity):
+            self._drop_oldest()
+        slot = (self.head + self.count) % self.capacity
+        self.times[slot] = t
+        self.xs[slot] = dx
+        self.ys[slot] = dy
+        self.sum_x += dx
+        self.sum_y += dy
+        self.count += 1
     def average(self):
-        if not self.xs or not self.ys:
+        if not self.count:
             return 0, 0
-        return sum(self.xs) / len(self.xs), sum(self.ys) / len(self.ys)
+        return self.sum_x / self.count, self.sum_y / self.count
     def clear(self):
-        self.xs.clear()
-        self.ys.clear()
-
-smoother = MovingAverage()
+        self.head = 0
+        self.count = 0
+        self.sum_x = self.sum_y = 0
+    def _drop_oldest(self):
+        self.sum_x -= self.xs[self.head]
+        self.sum_y -= self.ys[self.head]
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
+
+class PollingRateMeter:
+    """Works out the mouse polling rate from the intervals between its motion reports."""
+    def __init__(self):
+        self.last = None
+        self.intervals = []
+        self.rate = None
+        self.measured = None
+    def report(self, t):
+        """Feed one report timestamp; returns True once, when the rate has been settled."""
+        if self.last is not None and 0 < t - self.last < 0.05:  # longer gaps: the mouse stopped
+            self.intervals.append(t - self.last)
+        self.last = t
+        if len(self.intervals) < POLL_RATE_SAMPLES:
+            return False
+        self.intervals.sort()
+        self.measured = 1.0 / self.intervals[len(self.intervals) // 2]
+        self.rate = min(POLL_RATES, key=lambda rate: abs(math.log(rate / self.measured)))
+        self.intervals = []
+        return True
+
+poll_meter = PollingRateMeter()
 
 cursor_centering_enabled = threading.Event()
 cursor_centering_enabled.set()  # initially on
@@ -231,34 +1358,376 @@ mouse_smoothing_enabled = threading.Event()
 mouse_smoothing_enabled.set()  # smoothing initially enabled
 
 exiting = threading.Event()
+# Written once on shutdown and never read back, so it stays readable and every select() that
+# includes it returns at once
+shutdown_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+
+def request_exit(reason):
+    """Start shutdown from any thread or signal handler; every blocking wait wakes immediately."""
+    if not exiting.is_set():
+        log(f"{reason}: exiting script cleanly...")
+    exiting.set()
+    os.eventfd_write(shutdown_fd, 1)
+
+# Only x_worker_thread touches disp (Xlib connections are not thread-safe); everyone else
+# queues a function for it and returns without waiting for the X server
+x_commands = deque()
+x_wake_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+
+def x_call(command):
+    x_commands.append(command)
+    os.eventfd_write(x_wake_fd, 1)
 
 def grab_cursor():
+    if args.no_x:
+        evdev_grab_mouse()
+    else:
+        x_call(x_grab_cursor)
+
+def ungrab_cursor():
+    if args.no_x:
+        evdev_ungrab_mouse()
+    else:
+        x_call(x_ungrab_cursor)
+
+def set_cursor_centering(enabled):
+    if enabled:
+        cursor_centering_enabled.set()
+    else:
+        cursor_centering_enabled.clear()
+    if not args.no_x:
+        x_call(lambda: None)  # wake the worker so it starts or stops its centering ticks
+
+# Without X the pointer is captured at the device instead: while the mouse is grabbed
+# (EVIOCGRAB) nothing but this script sees its motion, so there is nothing to re-centre
+def evdev_grab_mouse():
+    try:
+        mouse.grab()
+    except OSError as e:
+        log(f"Failed to grab (lock) mouse. Error: {e}", WARNING)
+        return
+    log("Mouse locked (grabbed).")
+    cursor_locked.set()
+
+def evdev_ungrab_mouse():
+    try:
+        mouse.ungrab()
+    except OSError:
+        pass
+    log("Mouse unlocked (ungrabbed).")
+    cursor_locked.clear()
+
+def x_grab_cursor():
+    # The one request here that needs a reply
+    x_round_trips['worker'] += 1
     result = root.grab_pointer(True,
                                X.PointerMotionMask | X.ButtonPressMask | X.ButtonReleaseMask,
                                X.GrabModeAsync, X.GrabModeAsync,
                                X.NONE, X.NONE, X.CurrentTime)
-    disp.sync()
     if result == X.GrabSuccess:
-        print("Cursor locked (grabbed).")
+        log("Cursor locked (grabbed).")
         cursor_locked.set()
     else:
-        print("Failed to grab (lock) cursor.")
+        log("Failed to grab (lock) cursor.", WARNING)
 
-def ungrab_cursor():
+def x_ungrab_cursor():
     disp.ungrab_pointer(X.CurrentTime)
-    disp.sync()
-    print("Cursor unlocked (ungrabbed).")
+    disp.flush()
+    log("Cursor unlocked (ungrabbed).")
     cursor_locked.clear()
 
+# Profiles: whisk_keymap.conf is the 'default' profile, every whisk_profiles/<name>.conf
+# adds another one. Besides bindings a profile file may set:
+#   SENSITIVITY_LEVELS=1,2,3  SENSITIVITY=2  SMOOTHING=on  SMOOTHING_MS=20  (averaging window)
+#   CENTERING=on  GRAB=off  WM_CLASS=xemu   (auto-select when that window gets focus)
+#   CENTER_TARGET=monitor|window  (centre on the primary monitor, or on the focused
+#                                  WM_CLASS window itself, following its moves)
+#   TRIGGER_ATTACK_MS=120  TRIGGER_RELEASE_MS=60  TRIGGER_CURVE=2.0 (exponent)
+#   TRIGGER_MAX=255  TRIGGER_WHEEL_STEP=16  (mouse wheel raises/lowers TRIGGER_MAX)
+#   WHEEL_PULSE_MS=40  (how long a wheel notch holds its MOUSE_WHEEL_* target)
+#   LEFT_STICK_SOCD=last|neutral|first  (opposite WASD keys held together)
+#   LEFT_STICK_GATE=circle|square  (circle keeps diagonals inside a real stick's range)
+#   LEFT_STICK_RAMP_MS=150  (time to full deflection, 0 = instant; per binding with
+#                            e.g. ABS_LEFT_STICK_Y_NEG_RAMP_MS=300)  LEFT_STICK_CURVE=1.0
+#   LEFT_STICK_WALK_KEY=KEY_LEFTALT  LEFT_STICK_WALK_FRACTION=0.5  (held: cap deflection)
+#   TURBO_BTN_A=15,50,hold  (rapid-fire: presses per second, % of each period held down,
+#                            hold = while the key is down, toggle = each press starts/stops)
+#   MACRO_KEY_F1=0 BTN_A 1, 50 BTN_A 0, 120 ABS_Y 0, 300 ABS_Y 128
+#                           (on press: <ms from start> <button or ABS_* axis> <value>, ...)
+#   RIGHT_STICK_MODE=delta|flick|region  (flick: mouse X turns the camera by angle;
+#       FLICK_TURN_RATE=360 deg/s the game turns at full deflection, FLICK_DEGREES_PER_COUNT=0.1,
+#       FLICK_DEADZONE=0.0 and FLICK_CURVE=1.0 of the game's stick response.
+#       region: a virtual pointer in REGION_SIZE=800x600 mouse counts sets the deflection,
+#       REGION_CURVE=1.0. Counts are multiplied by the sensitivity level in both modes.)
+#   LAYER_DPAD=KEY_CAPSLOCK,hold  DPAD:BTN_DPAD_UP=KEY_W  (hold|toggle; DPAD:<entry> rebinds
+#                                                           a key while the layer is active)
+PROFILES_DIRNAME = 'whisk_profiles'
+DEFAULT_SENSITIVITY_LEVELS = [1,2,3,4,5,6,7,8,9,10]
+DEFAULT_SENSITIVITY = 5
+# Trigger ramps default to instant full presses, as before
+DEFAULT_TRIGGER_SETTINGS = {'attack_ms': 0, 'release_ms': 0, 'curve': 1.0, 'max': 255, 'wheel_step': 0}
+
+def parse_flag(value, default):
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'on', 'yes', 'true')
+
+def compile_stick_settings(raw_map):
+    policy = raw_map.get('LEFT_STICK_SOCD', 'last').strip().lower()
+    gate = raw_map.get('LEFT_STICK_GATE', 'circle').strip().lower()
+    exponent = float(raw_map.get('LEFT_STICK_CURVE', 1.0))
+    walk_fraction = float(raw_map.get('LEFT_STICK_WALK_FRACTION', 0.5))
+    walk_name = raw_map.get('LEFT_STICK_WALK_KEY')
+    walk_key = resolve_code(walk_name) if walk_name else None
+    if walk_name and walk_key is None:
+        raise ValueError(f"LEFT_STICK_WALK_KEY '{walk_name}' is not a key name")
+    default_ms = int(raw_map.get('LEFT_STICK_RAMP_MS', 0))
+    rates = {}
+    for name, bit in AXIS_OUTPUTS.items():
+        ramp_ms = int(raw_map.get(name + '_RAMP_MS', default_ms))
+        rates[bit] = 1000.0 / ramp_ms if ramp_ms > 0 else None
+    return {
+        'table': build_stick_table(policy, gate, exponent),
+        'walk_table': build_stick_table(policy, gate, exponent, max(0.0, min(1.0, walk_fraction))),
+        'walk_key': walk_key,
+        'rates': rates,
+        'curve': build_stick_curve(exponent),
+    }
+
+def compile_turbo_settings(raw_map):
+    """TURBO_<button>=rate_hz[,duty_percent][,hold|toggle] -> name: (period, on_time, toggle)."""
+    turbo = {}
+    for name in BUTTON_OUTPUTS:
+        value = raw_map.get('TURBO_' + name)
+        if not value:
+            continue
+        fields = [field.strip().lower() for field in value.split(',')]
+        mode = fields.pop() if fields[-1] in ('hold', 'toggle') else 'hold'
+        rate = float(fields[0])
+        duty = float(fields[1]) if len(fields) > 1 else 50.0
+        if rate <= 0 or not 0 < duty < 100:
+            raise ValueError(f"TURBO_{name}={value}: rate must be > 0 and duty between 0 and 100")
+        period = 1.0 / rate
+        turbo[name] = (period, period * duty / 100.0, mode == 'toggle')
+    return turbo
+
+def compile_macros(raw_map):
+    """MACRO_<key> entries -> key code: compiled steps (bad key names are reported by the validator)."""
+    macros = {}
+    for entry, text in raw_map.items():
+        if entry.startswith('MACRO_'):
+            code = resolve_code(entry[len('MACRO_'):])
+            if code is not None and code not in CONSUMED_HOTKEYS:
+                macros[code] = compile_macro(text)
+    return macros
+
+def compile_aim_settings(raw_map):
+    mode = raw_map.get('RIGHT_STICK_MODE', 'delta').strip().lower()
+    if mode not in RIGHT_STICK_MODES:
+        raise ValueError(f"RIGHT_STICK_MODE must be one of {', '.join(RIGHT_STICK_MODES)}, not '{mode}'")
+    width, _, height = raw_map.get('REGION_SIZE', '800x600').lower().partition('x')
+    return {
+        'mode': mode,
+        'flick_turn_rate': float(raw_map.get('FLICK_TURN_RATE', 360)),
+        'flick_degrees_per_count': float(raw_map.get('FLICK_DEGREES_PER_COUNT', 0.1)),
+        'flick_table': build_flick_table(float(raw_map.get('FLICK_DEADZONE', 0.0)),
+                                         float(raw_map.get('FLICK_CURVE', 1.0))),
+        'region_width': max(2, int(width)),
+        'region_height': max(2, int(height or width)),
+        'region_table': build_stick_curve(float(raw_map.get('REGION_CURVE', 1.0))),
+    }
+
+def compile_profile(name, raw_map):
+    """Resolve a raw config dict into plain data (ints, strings, tuples) that marshal can cache."""
+    keymap = build_keymap(raw_map)
+    levels = DEFAULT_SENSITIVITY_LEVELS
+    if 'SENSITIVITY_LEVELS' in raw_map:
+        levels = [int(v) for v in raw_map['SENSITIVITY_LEVELS'].split(',') if v.strip()]
+    start = int(raw_map.get('SENSITIVITY', DEFAULT_SENSITIVITY))
+    compiled = dict(compile_keymap(keymap), macros=compile_macros(raw_map))
+    center_target = raw_map.get('CENTER_TARGET', 'monitor').strip().lower()
+    if center_target not in ('monitor', 'window'):
+        raise ValueError(f"CENTER_TARGET must be monitor or window, not '{center_target}'")
+    problems, notes = validate_keymap(raw_map, keymap)
+    return {
+        'name': name,
+        'keymap': keymap,
+        'compiled': compiled,
+        'layers': compile_layers(raw_map, compiled),
+        'problems': problems,
+        'notes': notes,
+        'sensitivity_levels': levels,
+        'sensitivity_index': levels.index(start) if start in levels else 0,
+        'smoothing': parse_flag(raw_map.get('SMOOTHING'), True),
+        # SMOOTHING_SIZE counted samples; at the usual 1 kHz that is the same number of ms
+        'smoothing_ms': int(raw_map.get('SMOOTHING_MS', raw_map.get('SMOOTHING_SIZE', 20))),
+        'centering': parse_flag(raw_map.get('CENTERING'), True),
+        'center_target': center_target,
+        'grab': parse_flag(raw_map.get('GRAB'), False),
+        'wm_class': {c.strip().lower() for c in raw_map.get('WM_CLASS', '').split(',') if c.strip()},
+        'wheel_pulse_ms': int(raw_map.get('WHEEL_PULSE_MS', 40)),
+        'stick': compile_stick_settings(raw_map),
+        'turbo': compile_turbo_settings(raw_map),
+        'aim': compile_aim_settings(raw_map),
+        'trigger': {
+            'attack_ms': int(raw_map.get('TRIGGER_ATTACK_MS', DEFAULT_TRIGGER_SETTINGS['attack_ms'])),
+            'release_ms': int(raw_map.get('TRIGGER_RELEASE_MS', DEFAULT_TRIGGER_SETTINGS['release_ms'])),
+            'curve': build_curve_table(float(raw_map.get('TRIGGER_CURVE', DEFAULT_TRIGGER_SETTINGS['curve']))),
+            'max': clamp(int(raw_map.get('TRIGGER_MAX', DEFAULT_TRIGGER_SETTINGS['max']))),
+            'wheel_step': int(raw_map.get('TRIGGER_WHEEL_STEP', DEFAULT_TRIGGER_SETTINGS['wheel_step'])),
+        },
+    }
+
+def instantiate_profile(data):
+    """Add the live (non-cacheable) parts to compiled profile data."""
+    profile = dict(data)
+    profile['smoother'] = WindowedAverage(data['smoothing_ms'], poll_meter.rate or DEFAULT_POLL_RATE)
+    profile['turbo_buttons'] = {BUTTON_OUTPUTS[name]: TurboButton(name, BUTTON_OUTPUTS[name], *settings)
+                                for name, settings in data['turbo'].items()}
+    return profile
+
+def build_profile(name, raw_map):
+    """Precompile everything a profile needs, so switching to it is only a few assignments."""
+    return instantiate_profile(compile_profile(name, raw_map))
+
+# Compiled profiles are cached in a marshal blob, keyed per file by mtime and size.
+# This script's own mtime is part of the key, so editing the script drops the cache too.
+PROFILE_CACHE_FILENAME = '.whisk_keymap.cache'
+
+def read_profile_cache():
+    try:
+        with open(PROFILE_CACHE_FILENAME, 'rb') as f:
+            cache = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def save_profile_cache():
+    global profile_cache_dirty
+    if not profile_cache_dirty:
+        return
+    # Drop entries of config files that no longer exist
+    cache = {path: entry for path, entry in profile_cache.items() if os.path.isfile(path)}
+    tmp_path = PROFILE_CACHE_FILENAME + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            marshal.dump(cache, f)
+        os.replace(tmp_path, PROFILE_CACHE_FILENAME)
+    except OSError as e:
+        log(f"Could not write profile cache '{PROFILE_CACHE_FILENAME}': {e}", WARNING)
+    profile_cache_dirty = False
+
+def cache_stamp(filepath):
+    st = os.stat(filepath)
+    return (os.stat(os.path.abspath(__file__)).st_mtime_ns, marshal.version, st.st_mtime_ns, st.st_size,
+            args.hires_axes)
+
+profile_cache = read_profile_cache()
+profile_cache_dirty = False
+
+def load_profile_file(name, filepath):
+    global profile_cache_dirty
+    try:
+        key = os.path.abspath(filepath)
+        stamp = cache_stamp(filepath)
+        cached = profile_cache.get(key)
+        if cached is not None and cached[0] == stamp and cached[1]['name'] == name:
+            data = cached[1]
+            source = 'cache'
+        else:
+            data = compile_profile(name, load_keymap_from_file(filepath))
+            profile_cache[key] = (stamp, data)
+            profile_cache_dirty = True
+            source = filepath
+        profile = instantiate_profile(data)
+    except Exception as e:
+        log(f"Failed to load profile '{name}' from '{filepath}'. Error: {e}", WARNING)
+        return None
+    for problem in profile['problems']:
+        log(f"Keymap problem in '{filepath}': {problem}", WARNING)
+    for note in profile['notes']:
+        log(f"Keymap note for '{filepath}': {note}")
+    if profile['problems'] and args.strict_keymap:
+        log(f"Refusing profile '{name}' from '{filepath}' (--strict-keymap).", WARNING)
+        return None
+    log(f"Loaded profile '{name}' from '{source}': {profile['keymap']}")
+    return profile
+
+def load_profiles():
+    log(f"Looking for config file '{CONFIG_FILENAME}' in current directory: {os.getcwd()}")
+    default = None
+    if os.path.isfile(CONFIG_FILENAME):
+        default = load_profile_file('default', CONFIG_FILENAME)
+    else:
+        log(f"Config file '{CONFIG_FILENAME}' not found, using default keymap.")
+    if default is None:
+        default = build_profile('default', {})
+    loaded = [default]
+    if os.path.isdir(PROFILES_DIRNAME):
+        for filename in sorted(os.listdir(PROFILES_DIRNAME)):
+            if filename.endswith('.conf'):
+                profile = load_profile_file(filename[:-5], os.path.join(PROFILES_DIRNAME, filename))
+                if profile is not None:
+                    loaded.append(profile)
+    save_profile_cache()
+    return loaded
+
+def set_profile_state(index):
+    """Point all the live settings at a precompiled profile (no device or X traffic)."""
+    global active_profile_index, loaded_keymap, active_keymap, smoother
+    global sensitivity_levels, current_sensitivity_index, current_sensitivity, wheel_pulse_time
+    global stick_table, stick_walk_table, stick_walk_key, turbo_buttons, right_aim, resume_centering
+    profile = profiles[index]
+    active_profile_index = index
+    loaded_keymap = profile['keymap']
+    # Readers grab this reference once per event, so the swap is atomic for them
+    active_keymap = profile['compiled']
+    layer_stack.clear()
+    sensitivity_levels = profile['sensitivity_levels']
+    current_sensitivity_index = profile['sensitivity_index']
+    current_sensitivity = sensitivity_levels[current_sensitivity_index]
+    smoother = profile['smoother']
+    smoother.clear()
+    if profile['smoothing']:
+        mouse_smoothing_enabled.set()
+    else:
+        mouse_smoothing_enabled.clear()
+    if suspended:
+        resume_centering = profile['centering']
+    else:
+        set_cursor_centering(profile['centering'])
+    for ramp in trigger_ramps:
+        ramp.configure(profile['trigger'])
+    wheel_pulse_time = profile['wheel_pulse_ms'] / 1000.0
+    turbo_buttons = profile['turbo_buttons']
+    aim = profile['aim']
+    right_aim = aim_modes.get(aim['mode'])
+    for mode in aim_modes.values():
+        mode.configure(aim)
+    stick = profile['stick']
+    stick_table = stick['table']
+    stick_walk_table = stick['walk_table']
+    stick_walk_key = stick['walk_key']
+    for ramp in stick_ramps:
+        ramp.configure(stick['rates'], stick['curve'])
+
+profiles = load_profiles()
+set_profile_state(0)
+
+def describe_mouse_bindings():
+    return '\n'.join(f"- Mouse {entry[6:]}: {loaded_keymap[entry]}"
+                     for entry in MOUSE_ENTRIES if loaded_keymap[entry] is not None)
+
 def print_keybinds():
     kb = f"""
-Keybindings (loaded from {'whisk_keymap.conf' if os.path.isfile(CONFIG_FILENAME) else 'default hardcoded'}):
+Keybindings (profile #{active_profile_index + 1} '{profiles[active_profile_index]['name']}'):
 
 - Cycle mouse sensitivity: V
 - Cursor lock toggle: N
 - Cursor centering toggle: Shift + Alt + P
 - EMERGENCY switch (quit script): Shift + X + Q + S
 - Toggle mouse smoothing: M
+- Switch profile: Shift + Alt + 1..9 ({', '.join(f"{i + 1}={p['name']}" for i, p in enumerate(profiles))})
 
 - Left stick click: {loaded_keymap['BTN_THUMBL']}
 - Right stick click: {loaded_keymap['BTN_THUMBR']}
@@ -266,8 +1735,7 @@ Keybindings (loaded from {'whisk_keymap.conf' if os.path.isfile(CONFIG_FILENAME)
 - Button B: {loaded_keymap['BTN_B']}
 - Button X: {loaded_keymap['BTN_X']}
 - Button Y: {loaded_keymap['BTN_Y']}
-- Left trigger (analog): Middle mouse button
-- Right trigger (analog): Left mouse button
+{describe_mouse_bindings()}
 - BTN_MODE (Guide button): {loaded_keymap['BTN_MODE']}
 - Digital Left Trigger (BTN_TL2): {loaded_keymap['BTN_TL2']}
 - Digital Right Trigger (BTN_TR2): {loaded_keymap['BTN_TR2']}
@@ -281,13 +1749,21 @@ Keybindings (loaded from {'whisk_keymap.conf' if os.path.isfile(CONFIG_FILENAME)
 - Left stick Y axis positive: {loaded_keymap['ABS_LEFT_STICK_Y_POS']} (down)
 - Left stick Y axis negative: {loaded_keymap['ABS_LEFT_STICK_Y_NEG']} (up)
 
+- Dump the flight recorder: Shift+Alt+D
 - Show this help: H
 """
-    print(kb)
+    log(kb)
 
-def is_key_pressed(keyname):
-    with held_keys_lock:
-        return keyname in held_keys
+EMERGENCY_KEYS = {evdev.ecodes.KEY_LEFTSHIFT, evdev.ecodes.KEY_RIGHTSHIFT,
+                  evdev.ecodes.KEY_X, evdev.ecodes.KEY_Q, evdev.ecodes.KEY_S}
+
+
+def is_key_pressed(code):
+    return code in held_keys
+
+def shift_alt_held():
+    return ((is_key_pressed(evdev.ecodes.KEY_LEFTSHIFT) or is_key_pressed(evdev.ecodes.KEY_RIGHTSHIFT)) and
+            (is_key_pressed(evdev.ecodes.KEY_LEFTALT) or is_key_pressed(evdev.ecodes.KEY_RIGHTALT)))
 
 def hotkey_check(event_key, pressed):
     global current_sensitivity, current_sensitivity_index
@@ -301,248 +1777,987 @@ def hotkey_check(event_key, pressed):
     if not hasattr(hotkey_check, "emergency_down"):
         hotkey_check.emergency_down = False
 
-    if event_key == 'KEY_P':
-        shift_pressed = is_key_pressed('KEY_LEFTSHIFT') or is_key_pressed('KEY_RIGHTSHIFT')
-        alt_pressed = is_key_pressed('KEY_LEFTALT') or is_key_pressed('KEY_RIGHTALT')
+    if event_key == evdev.ecodes.KEY_P:
+        shift_pressed = is_key_pressed(evdev.ecodes.KEY_LEFTSHIFT) or is_key_pressed(evdev.ecodes.KEY_RIGHTSHIFT)
+        alt_pressed = is_key_pressed(evdev.ecodes.KEY_LEFTALT) or is_key_pressed(evdev.ecodes.KEY_RIGHTALT)
         if pressed and shift_pressed and alt_pressed and not hotkey_check.p_down:
+            hotkey_hits['centering'] += 1
             if cursor_centering_enabled.is_set():
-                cursor_centering_enabled.clear()
-                print("Cursor centering toggled OFF")
+                set_cursor_centering(False)
+                log("Cursor centering toggled OFF")
             else:
-                cursor_centering_enabled.set()
-                print("Cursor centering toggled ON")
+                set_cursor_centering(True)
+                log("Cursor centering toggled ON")
             hotkey_check.p_down = True
         elif not pressed:
             hotkey_check.p_down = False
 
-    emergency_keys = {'KEY_LEFTSHIFT', 'KEY_RIGHTSHIFT', 'KEY_X', 'KEY_Q', 'KEY_S'}
-    if event_key in emergency_keys:
-        shift_pressed = is_key_pressed('KEY_LEFTSHIFT') or is_key_pressed('KEY_RIGHTSHIFT')
+    if event_key in EMERGENCY_KEYS:
+        shift_pressed = is_key_pressed(evdev.ecodes.KEY_LEFTSHIFT) or is_key_pressed(evdev.ecodes.KEY_RIGHTSHIFT)
         all_pressed = (shift_pressed and
-                       is_key_pressed('KEY_X') and
-                       is_key_pressed('KEY_Q') and
-                       is_key_pressed('KEY_S'))
+                       is_key_pressed(evdev.ecodes.KEY_X) and
+                       is_key_pressed(evdev.ecodes.KEY_Q) and
+                       is_key_pressed(evdev.ecodes.KEY_S))
         if pressed and all_pressed and not hotkey_check.emergency_down:
-            print("Emergency switch-off activated: exiting script cleanly...")
-            try:
-                if cursor_locked.is_set():
-                    ungrab_cursor()
-            except Exception:
-                pass
-            exiting.set()
-            sys.exit(0)
+            hotkey_hits['emergency'] += 1
+            flight_recorder.dump('emergency')
+            # input_thread stops after this batch and leaves the pad neutral
+            request_exit("Emergency switch-off activated")
+            hotkey_check.emergency_down = True
         elif not pressed:
             hotkey_check.emergency_down = False
 
-    if event_key == 'KEY_M':
+    if event_key == evdev.ecodes.KEY_M:
         if pressed and not hotkey_check.m_down:
+            hotkey_hits['smoothing'] += 1
             if mouse_smoothing_enabled.is_set():
                 mouse_smoothing_enabled.clear()
                 smoother.clear()
-                print("Mouse smoothing toggled OFF")
+                log("Mouse smoothing toggled OFF")
             else:
                 mouse_smoothing_enabled.set()
-                print("Mouse smoothing toggled ON")
+                log("Mouse smoothing toggled ON")
             hotkey_check.m_down = True
         elif not pressed:
             hotkey_check.m_down = False
 
-    if event_key == 'KEY_H':
+    if event_key == evdev.ecodes.KEY_H:
         if pressed and not hotkey_check.h_down:
+            hotkey_hits['help'] += 1
             print_keybinds()
             hotkey_check.h_down = True
         elif not pressed:
             hotkey_check.h_down = False
 
-def keyboard_thread():
-    global left_x, left_y, current_sensitivity_index, current_sensitivity
-
-    n_was_down = False
-
-    for event in keyboard.read_loop():
-        if exiting.is_set():
-            break
-        if event.type == evdev.ecodes.EV_KEY:
-            ev = evdev.categorize(event)
-            key = ev.keycode if isinstance(ev.keycode, str) else ev.keycode
-            pressed = ev.keystate in (evdev.KeyEvent.key_down, evdev.KeyEvent.key_hold)
-
-            with held_keys_lock:
-                if pressed:
-                    if key in held_keys:
-                        pass
-                    else:
-                        held_keys.add(key)
-                else:
-                    if key in held_keys:
-                        held_keys.remove(key)
-                    else:
-                        continue
-
-            hotkey_check(key, pressed)
-
-            if key == 'KEY_V' and pressed:
-                with sensitivity_lock:
-                    current_sensitivity_index = (current_sensitivity_index + 1) % len(sensitivity_levels)
-                    current_sensitivity = sensitivity_levels[current_sensitivity_index]
-                print(f"Mouse sensitivity set to: {current_sensitivity}")
-                continue
-
-            if key == 'KEY_N':
-                if pressed and not n_was_down:
-                    if cursor_locked.is_set():
-                        ungrab_cursor()
-                    else:
-                        grab_cursor()
-                n_was_down = pressed
-
-            # Map buttons from loaded_keymap
-            if key == loaded_keymap['BTN_THUMBL']:
-                device.emit(uinput.BTN_THUMBL, pressed)
-            elif key == loaded_keymap['BTN_THUMBR']:
-                device.emit(uinput.BTN_THUMBR, pressed)
-            elif key == loaded_keymap['BTN_A']:
-                device.emit(uinput.BTN_A, pressed)
-            elif key == loaded_keymap['BTN_B']:
-                device.emit(uinput.BTN_B, pressed)
-            elif key == loaded_keymap['BTN_X']:
-                device.emit(uinput.BTN_X, pressed)
-            elif key == loaded_keymap['BTN_Y']:
-                device.emit(uinput.BTN_Y, pressed)
-            elif key == loaded_keymap['BTN_TL']:
-                device.emit(uinput.BTN_TL, pressed)
-            elif key == loaded_keymap['BTN_TR']:
-                device.emit(uinput.BTN_TR, pressed)
-            elif key == loaded_keymap['BTN_TL2']:
-                device.emit(uinput.BTN_TL2, pressed)
-            elif key == loaded_keymap['BTN_TR2']:
-                device.emit(uinput.BTN_TR2, pressed)
-            elif key == loaded_keymap['BTN_MODE']:
-                device.emit(uinput.BTN_MODE, pressed)
-            elif key == loaded_keymap['BTN_START']:
-                device.emit(uinput.BTN_START, pressed)
-            elif key == loaded_keymap['BTN_SELECT']:
-                device.emit(uinput.BTN_SELECT, pressed)
-            elif key == loaded_keymap['BTN_DPAD_UP']:
-                device.emit(uinput.BTN_DPAD_UP, pressed)
-            elif key == loaded_keymap['BTN_DPAD_DOWN']:
-                device.emit(uinput.BTN_DPAD_DOWN, pressed)
-            elif key == loaded_keymap['BTN_DPAD_LEFT']:
-                device.emit(uinput.BTN_DPAD_LEFT, pressed)
-            elif key == loaded_keymap['BTN_DPAD_RIGHT']:
-                device.emit(uinput.BTN_DPAD_RIGHT, pressed)
-
-            # Left stick axes handling (two keys per axis)
-            # For X axis
-            if key == loaded_keymap['ABS_LEFT_STICK_X_POS']:
-                left_x = 255 if pressed else 128
-                device.emit(uinput.ABS_X, left_x, syn=False)
-            elif key == loaded_keymap['ABS_LEFT_STICK_X_NEG']:
-                left_x = 0 if pressed else 128
-                device.emit(uinput.ABS_X, left_x, syn=False)
-
-            # For Y axis
-            elif key == loaded_keymap['ABS_LEFT_STICK_Y_POS']:
-                left_y = 255 if pressed else 128
-                device.emit(uinput.ABS_Y, left_y, syn=False)
-            elif key == loaded_keymap['ABS_LEFT_STICK_Y_NEG']:
-                left_y = 0 if pressed else 128
-                device.emit(uinput.ABS_Y, left_y, syn=False)
-            device.syn()
-
-def mouse_thread():
-    global right_x, right_y, left_trigger, right_trigger
-
-    for event in mouse.read_loop():
-        if exiting.is_set():
-            break
-        if event.type == evdev.ecodes.EV_REL:
-            dx, dy = 0, 0
-            if event.code == evdev.ecodes.REL_X:
-                with sensitivity_lock:
-                    dx = event.value * current_sensitivity
-            elif event.code == evdev.ecodes.REL_Y:
-                with sensitivity_lock:
-                    dy = event.value * current_sensitivity
-
-            if mouse_smoothing_enabled.is_set():
-                smoother.add(dx, dy)
-                avg_dx, avg_dy = smoother.average()
+# Raw struct input_event layout: struct timeval (two longs), __u16 type, __u16 code, __s32 value
+EVENT_FORMAT = 'llHHi'
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+EVENT_TIME = struct.Struct('ll')
+READ_BATCH_EVENTS = 256  # how many events one read() may drain at once
+
+EV_SYN = evdev.ecodes.EV_SYN
+SYN_REPORT = evdev.ecodes.SYN_REPORT
+SYN_DROPPED = evdev.ecodes.SYN_DROPPED
+EV_KEY = evdev.ecodes.EV_KEY
+KEY_REPEAT = 2  # EV_KEY value of kernel autorepeat; dropped before dispatch
+EV_REL = evdev.ecodes.EV_REL
+REL_X = evdev.ecodes.REL_X
+REL_Y = evdev.ecodes.REL_Y
+
+def read_events(dev):
+    """Drain everything pending on dev's fd with a single read() and unpack it in bulk."""
+    global batch_time
+    try:
+        data = os.read(dev.fd, EVENT_SIZE * READ_BATCH_EVENTS)
+    except BlockingIOError:
+        return ()
+    if data:
+        events_read[dev.fd] += len(data) // EVENT_SIZE
+        sec, usec = EVENT_TIME.unpack_from(data, len(data) - EVENT_SIZE)
+        batch_time = sec + usec / 1000000
+    return struct.iter_unpack(EVENT_FORMAT, data)
+
+n_was_down = False
+
+# After SYN_DROPPED the kernel lost events: everything up to the next SYN_REPORT is discarded
+# and the real key state is read back (EVIOCGKEY) and diffed against ours instead.
+syn_dropped_counts = {'keyboard': 0, 'mouse': 0}
+keyboard_dropping = False
+mouse_dropping = False
+
+def handle_keyboard_batch(events):
+    """Returns True if the batch wrote anything to the pad, so unbound keys and autorepeat
+    cost no frame."""
+    global keyboard_dropping
+    writes = counters['writes']
+    record = flight_recorder.record
+    for sec, usec, etype, code, value in events:
+        record(sec + usec / 1000000, SOURCE_KEYBOARD, etype, code, value)
+        if etype == EV_KEY:
+            if value == KEY_REPEAT:
+                counters['autorepeat_dropped'] += 1
+            elif not keyboard_dropping:
+                handle_key_event(code, value)
+        elif etype == EV_SYN:
+            if code == SYN_DROPPED:
+                keyboard_dropping = True
+                syn_dropped_counts['keyboard'] += 1
+            elif code == SYN_REPORT and keyboard_dropping:
+                keyboard_dropping = False
+                resync_keyboard()
+    return counters['writes'] != writes
+
+def resync_keyboard():
+    """Release and press whatever changed while events were lost (caller sends the syn)."""
+    actual = set(keyboard.active_keys())
+    for code in held_keys - actual:
+        handle_key_event(code, 0)
+    for code in actual - held_keys:
+        handle_key_event(code, 1)
+
+def resync_mouse():
+    actual = set(mouse.active_keys())
+    now = time.monotonic()
+    for code in [code for code in pressed_mouse if code not in actual]:
+        release_held(pressed_mouse.pop(code), now)
+    keymap = active_keymap
+    for code in actual:
+        target = keymap['mouse_buttons'].get(code)
+        if target is not None and code not in pressed_mouse:
+            pressed_mouse[code] = press_target(target, now)
+
+def handle_key_event(code, value):
+    global current_sensitivity_index, current_sensitivity, n_was_down
+
+    pressed = value != 0  # key_down (autorepeat never gets this far, see handle_keyboard_batch)
+
+    if pressed:
+        held_keys.add(code)
+    else:
+        if code in held_keys:
+            held_keys.remove(code)
+        else:
+            return
+
+    hotkey_check(code, pressed)
+
+    if code == evdev.ecodes.KEY_V and pressed:
+        hotkey_hits['sensitivity'] += 1
+        current_sensitivity_index = (current_sensitivity_index + 1) % len(sensitivity_levels)
+        current_sensitivity = sensitivity_levels[current_sensitivity_index]
+        log(f"Mouse sensitivity set to: {current_sensitivity}")
+        return
+
+    if pressed and code in PROFILE_HOTKEYS and shift_alt_held():
+        hotkey_hits['profile'] += 1
+        switch_profile(PROFILE_HOTKEYS[code])
+        return
+
+    if pressed and code == FLIGHT_DUMP_HOTKEY and shift_alt_held():
+        hotkey_hits['flight_dump'] += 1
+        flight_recorder.dump('hotkey')
+        return
+
+    if code == evdev.ecodes.KEY_N:
+        if pressed and not n_was_down:
+            hotkey_hits['cursor_lock'] += 1
+            if cursor_locked.is_set():
+                ungrab_cursor()
             else:
-                avg_dx, avg_dy = dx, dy
-                smoother.clear()
-
-            right_x = clamp(right_x + int(avg_dx))
-            right_y = clamp(right_y + int(avg_dy))
-
-            device.emit(uinput.ABS_RX, right_x, syn=False)
-            device.emit(uinput.ABS_RY, right_y, syn=False)
-            device.syn()
-
-        elif event.type == evdev.ecodes.EV_KEY:
-            # Map mouse buttons to analog triggers per config
-            if event.code == loaded_keymap['RIGHT_TRIGGER_MOUSE']:
-                right_trigger = 255 if event.value else 0
-                device.emit(uinput.ABS_RZ, right_trigger)
-            elif event.code == loaded_keymap['LEFT_TRIGGER_MOUSE']:
-                left_trigger = 255 if event.value else 0
-                device.emit(uinput.ABS_Z, left_trigger)
-
-def cursor_centerer_thread():
+                grab_cursor()
+        n_was_down = pressed
+
+    keymap = active_keymap
+
+    # Layer keys swap the dispatch table. Everything below remembers what a press pushed,
+    # so a key held across the swap is still released on the layer it was pressed on.
+    layer = keymap['layer_keys'].get(code)
+    if layer is not None:
+        switch_layer(*layer, pressed)
+        return
+
+    # Macros start on press and run to the end by themselves
+    if pressed:
+        steps = keymap['macros'].get(code)
+        if steps is not None:
+            macro_runner.start(code, steps, time.monotonic())
+
+    # Buttons: a release lets go of whatever its press pushed
+    if pressed:
+        output = keymap['buttons'].get(code)
+        if output is not None and code not in pressed_outputs:
+            pressed_outputs[code] = press_button(output, time.monotonic())
+    else:
+        held = pressed_outputs.pop(code, None)
+        if held is not None:
+            release_held(held, time.monotonic())
+
+    # Analog triggers bound to keys ramp like the mouse button ones
+    if pressed:
+        ramp_index = keymap['trigger_keys'].get(code)
+        if ramp_index is not None and code not in pressed_triggers:
+            ramp = trigger_ramps[ramp_index]
+            pressed_triggers[code] = ramp
+            ramp.press(time.monotonic())
+    else:
+        ramp = pressed_triggers.pop(code, None)
+        if ramp is not None:
+            ramp.release(time.monotonic())
+
+    # Left stick: update the held-direction bitset, then one table lookup gives both targets
+    if code == stick_walk_key:
+        set_left_stick_bits(left_stick_bits, 0)
+    if pressed:
+        bit = keymap['axes'].get(code)
+        if bit is not None:
+            pressed_axes[code] = bit
+            set_left_stick_bits(left_stick_bits | bit, bit)
+    else:
+        bit = pressed_axes.pop(code, None)
+        if bit is not None:
+            set_left_stick_bits(left_stick_bits & ~bit, 0)
+
+def switch_layer(index, toggle, pressed):
+    global active_keymap
+    if toggle:
+        if not pressed:
+            return
+        if index in layer_stack:
+            layer_stack.remove(index)
+        else:
+            layer_stack.append(index)
+    elif pressed:
+        if index not in layer_stack:
+            layer_stack.append(index)
+    elif index in layer_stack:
+        layer_stack.remove(index)
+    profile = profiles[active_profile_index]
+    active_keymap = profile['layers'][layer_stack[-1]] if layer_stack else profile['compiled']
+
+def set_left_stick_bits(bits, pressed_bit):
+    global left_stick_bits, left_stick_order
+    left_stick_bits = bits
+    if pressed_bit:
+        mask, value = STICK_ORDER_ON_PRESS[pressed_bit]
+        left_stick_order = (left_stick_order & ~mask) | value
+    table = stick_walk_table if stick_walk_key in held_keys else stick_table
+    x, y = table[bits | left_stick_order << 4]
+    now = time.monotonic()
+    stick_ramps[0].set_target(x, now)
+    stick_ramps[1].set_target(y, now)
+
+# Wheel codes -> the notch axis they count for. With a hi-res capable mouse the kernel
+# sends both kinds, so only the hi-res ones are used then.
+WHEEL_HI_RES_UNITS = 120
+if evdev.ecodes.REL_WHEEL_HI_RES in mouse.capabilities().get(EV_REL, []):
+    wheel_axes = {evdev.ecodes.REL_WHEEL_HI_RES: evdev.ecodes.REL_WHEEL,
+                  evdev.ecodes.REL_HWHEEL_HI_RES: evdev.ecodes.REL_HWHEEL}
+else:
+    wheel_axes = {evdev.ecodes.REL_WHEEL: evdev.ecodes.REL_WHEEL,
+                  evdev.ecodes.REL_HWHEEL: evdev.ecodes.REL_HWHEEL}
+wheel_residual = {evdev.ecodes.REL_WHEEL: 0, evdev.ecodes.REL_HWHEEL: 0}
+
+def handle_wheel(axis, notches, keymap):
+    now = time.monotonic()
+    direction = 1 if notches > 0 else -1
+    target = keymap['wheel'].get((axis, direction))
+    if target is not None:
+        wheel_pulsers[(axis, direction)].notch(target, abs(notches), now)
+    if axis == evdev.ecodes.REL_WHEEL:
+        for ramp in trigger_ramps:
+            if ramp.wheel_step:
+                ramp.adjust_max(notches)
+
+def report_poll_rate():
+    """Size every profile's smoothing ring for the polling rate that was just measured."""
+    for profile in profiles:
+        profile['smoother'].resize(poll_meter.rate)
+    log(f"Mouse polling rate: {poll_meter.rate} Hz (measured {poll_meter.measured:.0f} Hz); "
+          f"smoothing window {smoother.window * 1000:.0f} ms = {smoother.capacity} report slots.")
+
+def handle_mouse_batch(events):
+    """Process a whole batch of mouse events; returns True if anything was written to the device."""
+    global right_x, right_y, mouse_dropping
+
+    moved = False
+    emitted = False
+    smoothing = mouse_smoothing_enabled.is_set()
+    keymap = active_keymap
+    dx = dy = 0  # motion of the report being read
+    gain = current_sensitivity * STICK_UNIT
+    aim = right_aim
+    now = time.monotonic() if aim is not None else 0.0
+    dropping = mouse_dropping
+    record = flight_recorder.record
+    for sec, usec, etype, code, value in events:
+        record(sec + usec / 1000000, SOURCE_MOUSE, etype, code, value)
+        if dropping:
+            if etype == EV_SYN and code == SYN_REPORT:
+                dropping = False
+                resync_mouse()
+                emitted = True
+            continue
+        if etype == EV_REL:
+            if code == REL_X:
+                dx += value * gain
+            elif code == REL_Y:
+                dy += value * gain
+            elif code in wheel_axes:
+                # Hi-res wheels report 120 units per notch; keep the remainder for the next event
+                axis = wheel_axes[code]
+                if code != axis:
+                    wheel_residual[axis] += value
+                    value = int(wheel_residual[axis] / WHEEL_HI_RES_UNITS)
+                    wheel_residual[axis] -= value * WHEEL_HI_RES_UNITS
+                if value:
+                    handle_wheel(axis, value, keymap)
+                    emitted = True
+
+        elif etype == EV_SYN:
+            if code == SYN_REPORT and (dx or dy):
+                # One motion report is complete: smooth it as a single sample at its own time
+                t = sec + usec / 1000000
+                if poll_meter.rate is None and poll_meter.report(t):
+                    report_poll_rate()
+                if smoothing:
+                    smoother.add(t, dx, dy)
+                    dx, dy = smoother.average()
+                if aim is not None:
+                    dx, dy = 0, aim.motion(dx, dy, now)
+                right_x = max(STICK_MIN, min(STICK_MAX, right_x + dx))
+                right_y = max(STICK_MIN, min(STICK_MAX, right_y + dy))
+                moved = True
+                dx = dy = 0
+            elif code == SYN_DROPPED:
+                dropping = True
+                dx = dy = 0  # the rest of this report is gone
+                syn_dropped_counts['mouse'] += 1
+
+        elif etype == EV_KEY:
+            # Mouse buttons go through the MOUSE_* routing table
+            if value:
+                target = keymap['mouse_buttons'].get(code)
+                if target is not None and code not in pressed_mouse:
+                    pressed_mouse[code] = press_target(target, time.monotonic())
+                    emitted = True
+            else:
+                held = pressed_mouse.pop(code, None)
+                if held is not None:
+                    release_held(held, time.monotonic())
+                    emitted = True
+
+    mouse_dropping = dropping
+    if dx or dy:
+        # A read that ended mid-report; the rest of it arrives with the next batch
+        right_x = max(STICK_MIN, min(STICK_MAX, right_x + dx))
+        right_y = max(STICK_MIN, min(STICK_MAX, right_y + dy))
+        moved = True
+    if not smoothing:
+        smoother.clear()
+    if moved:
+        # Only the final stick position of the batch matters to the reader
+        if aim is None:
+            device.emit(uinput.ABS_RX, round(right_x), syn=False)
+        if not isinstance(aim, RegionStick):
+            device.emit(uinput.ABS_RY, round(right_y), syn=False)
+        emitted = True
+    return emitted
+
+# inotify (via libc, no extra dependency) used to hot-reload the keymap file
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT_FORMAT = 'iIII'  # wd, mask, cookie, len; followed by len bytes of name
+INOTIFY_EVENT_SIZE = struct.calcsize(INOTIFY_EVENT_FORMAT)
+
+def open_config_watch():
+    """Watch the config file's directory (editors often replace the file); returns an fd or None."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        config_dir = os.path.dirname(os.path.abspath(CONFIG_FILENAME))
+        if libc.inotify_add_watch(fd, os.fsencode(config_dir), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, os.strerror(err))
+    except (OSError, AttributeError) as e:
+        log(f"Keymap hot-reload unavailable: {e}", WARNING)
+        return None
+    log(f"Watching '{CONFIG_FILENAME}' for changes.")
+    return fd
+
+def config_changed(fd):
+    """Drain pending inotify events; True if any of them concerned CONFIG_FILENAME."""
+    try:
+        data = os.read(fd, 4096)
+    except BlockingIOError:
+        return False
+    target = os.fsencode(os.path.basename(CONFIG_FILENAME))
+    changed = False
+    offset = 0
+    while offset < len(data):
+        _wd, _mask, _cookie, length = struct.unpack_from(INOTIFY_EVENT_FORMAT, data, offset)
+        offset += INOTIFY_EVENT_SIZE
+        if data[offset:offset + length].rstrip(b'\0') == target:
+            changed = True
+        offset += length
+    return changed
+
+def write_neutral_frame():
+    """Release everything and centre both sticks, in a single frame."""
+    global right_x, right_y
+    release_all_outputs()
+    right_x = right_y = float(STICK_CENTER)
+    device.emit(uinput.ABS_RX, STICK_CENTER, syn=False)
+    device.emit(uinput.ABS_RY, STICK_CENTER, syn=False)
+    device.syn()
+
+def release_all_outputs():
+    """Let go of every virtual button, stick and trigger (caller sends the syn)."""
+    for held in pressed_outputs.values():
+        if not isinstance(held, TurboButton):
+            device.emit(held, 0, syn=False)
+    pressed_outputs.clear()
+    for turbo in turbo_buttons.values():
+        turbo.reset()
+    macro_runner.cancel()
+    pressed_axes.clear()
+    set_left_stick_bits(0, 0)
+    for ramp in stick_ramps:
+        ramp.reset()
+    if right_aim is not None:
+        right_aim.reset()
+    now = time.monotonic()
+    for pulser in wheel_pulsers.values():
+        pulser.reset(now)
+    for held in pressed_mouse.values():
+        if not isinstance(held, (TriggerRamp, TurboButton)):
+            device.emit(held, 0, syn=False)
+    pressed_mouse.clear()
+    pressed_triggers.clear()
+    for ramp in trigger_ramps:
+        ramp.reset()
+
+def reload_keymap():
+    """Recompile the config file into the default profile; the uinput device is left untouched."""
+    profile = load_profile_file('default', CONFIG_FILENAME)
+    if profile is None:
+        log("Keymap not reloaded, keeping the current bindings.", WARNING)
+        return
+    save_profile_cache()
+    profiles[0] = profile
+    if active_profile_index == 0:
+        release_all_outputs()
+        set_profile_state(0)
+        device.syn()
+    log("Keymap reloaded.")
+
+def switch_profile(index):
+    """Swap the active precompiled profile, releasing whatever the old one was holding."""
+    global resume_grab
+    if index >= len(profiles):
+        log(f"No profile #{index + 1} (have {len(profiles)}).", WARNING)
+        return
+    if index == active_profile_index:
+        return
+    # Remember where the sensitivity was left for when we come back
+    profiles[active_profile_index]['sensitivity_index'] = current_sensitivity_index
+    release_all_outputs()
+    set_profile_state(index)
+    device.syn()
+    if suspended:
+        resume_grab = profiles[index]['grab']
+    elif profiles[index]['grab'] and not cursor_locked.is_set():
+        grab_cursor()
+    elif not profiles[index]['grab'] and cursor_locked.is_set():
+        ungrab_cursor()
+    log(f"Switched to profile #{index + 1} '{profiles[index]['name']}'.")
+
+# Other threads hand work to input_thread through this eventfd
+wake_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+pending_profile_index = None
+
+def request_profile(index):
+    global pending_profile_index
+    pending_profile_index = index
+    os.eventfd_write(wake_fd, 1)
+
+pending_focus = None
+
+def request_focus(focused):
+    global pending_focus
+    pending_focus = focused
+    os.eventfd_write(wake_fd, 1)
+
+# While suspended the readers are swapped for ones that only keep held_keys (for the emergency
+# combo) and drop everything else, so the active path never checks the focus state
+
+def handle_keyboard_suspended(events):
+    for _sec, _usec, etype, code, value in events:
+        if etype == EV_KEY and value != KEY_REPEAT:
+            if value:
+                held_keys.add(code)
+                if code in EMERGENCY_KEYS:
+                    hotkey_check(code, True)
+            else:
+                held_keys.discard(code)
+    return False
+
+def discard_batch(events):
+    return False
+
+keyboard_handler = handle_keyboard_batch
+mouse_handler = handle_mouse_batch
+
+def set_suspended(suspend):
+    global suspended, keyboard_handler, mouse_handler, resume_grab, resume_centering
+    global keyboard_dropping, mouse_dropping
+    if suspend == suspended:
+        return
+    suspended = suspend
+    if suspend:
+        keyboard_handler, mouse_handler = handle_keyboard_suspended, discard_batch
+        write_neutral_frame()
+        resume_grab = cursor_locked.is_set()
+        resume_centering = cursor_centering_enabled.is_set()
+        if resume_grab:
+            ungrab_cursor()
+        set_cursor_centering(False)
+        if args.grab_keyboard:
+            release_keyboard()
+        log("Game window lost focus: controller suspended.")
+    else:
+        if args.grab_keyboard:
+            grab_keyboard()
+        # Keys that went down elsewhere count as held but press nothing, as at startup
+        held_keys.clear()
+        held_keys.update(keyboard.active_keys())
+        keyboard_dropping = mouse_dropping = False
+        set_cursor_centering(resume_centering)
+        if resume_grab:
+            grab_cursor()
+        keyboard_handler, mouse_handler = handle_keyboard_batch, handle_mouse_batch
+        log("Game window focused: controller resumed.")
+
+FOCUS_WHITELIST = {c.strip().lower() for c in args.focus_whitelist.split(',') if c.strip()}
+
+def focus_profile_thread():
+    """Follow _NET_ACTIVE_WINDOW changes: request the profile whose WM_CLASS matches and,
+    with --suspend-unfocused, suspend or resume translation."""
+    fdisp = display.Display()  # own connection, Xlib connections must not be shared between threads
+    froot = fdisp.screen().root
+    net_active_window = fdisp.intern_atom('_NET_ACTIVE_WINDOW')
+    froot.change_attributes(event_mask=X.PropertyChangeMask)
+    classes_for_window = {}
+    followed = None  # window the X worker was last told to centre on
+    focused = True   # whether the input loop was last told a whitelisted window has focus
+
+    def lookup(window_id):
+        if window_id in classes_for_window:
+            return classes_for_window[window_id]
+        try:
+            x_round_trips['focus'] += 1
+            wm_class = fdisp.create_resource_object('window', window_id).get_wm_class()
+        except Exception:
+            wm_class = None
+        if not wm_class:
+            return set()  # not cached, the window may not have set WM_CLASS yet
+        names = classes_for_window[window_id] = {c.lower() for c in wm_class}
+        return names
+
+    def active_window_changed():
+        nonlocal followed, focused
+        x_round_trips['focus'] += 1
+        prop = froot.get_full_property(net_active_window, X.AnyPropertyType)
+        if not prop or not prop.value:
+            return
+        window_id = prop.value[0]
+        names = lookup(window_id)
+        index = next((i for i, p in enumerate(profiles) if p['wm_class'] & names), None)
+        if args.suspend_unfocused:
+            allowed = index is not None or bool(names & FOCUS_WHITELIST)
+            if allowed != focused:
+                focused = allowed
+                request_focus(allowed)
+        if index is not None and index != active_profile_index:
+            request_profile(index)
+        follow = window_id if index is not None and profiles[index]['center_target'] == 'window' else None
+        if follow != followed:
+            followed = follow
+            x_call(lambda: x_follow_window(follow))
+
+    active_window_changed()  # whatever has focus right now
+    xfd = fdisp.fileno()
+    while not exiting.is_set():
+        if not fdisp.pending_events():
+            ready, _, _ = select.select([xfd, shutdown_fd], [], [])
+            if shutdown_fd in ready:
+                break
+            continue
+        event = fdisp.next_event()
+        if event.type == X.PropertyNotify and event.atom == net_active_window:
+            active_window_changed()
+
+def input_thread():
+    global pending_profile_index, pending_focus
+    kbd_fd = keyboard.fd
+    mouse_fd = mouse.fd
+    fds = [kbd_fd, mouse_fd, wake_fd, shutdown_fd]
+    watch_fd = open_config_watch()
+    if watch_fd is not None:
+        fds.append(watch_fd)
+
+    reason = "Input loop stopped"
+    try:
+        while not exiting.is_set():
+            # Sleep until input arrives or the next timer is due (forever if none is pending)
+            timeout = max(0.0, timers[0][0] - time.monotonic()) if timers else None
+            ready, _, _ = select.select(fds, [], [], timeout)
+            if exiting.is_set():
+                break
+            if kbd_fd in ready:
+                if keyboard_handler(read_events(keyboard)):
+                    device.syn()
+                    observe_latency()
+                else:
+                    counters['suppressed_batches'] += 1
+            if mouse_fd in ready:
+                if mouse_handler(read_events(mouse)):
+                    device.syn()
+                    observe_latency()
+                else:
+                    counters['suppressed_batches'] += 1
+            if watch_fd is not None and watch_fd in ready and config_changed(watch_fd):
+                reload_keymap()
+            if wake_fd in ready:
+                os.eventfd_read(wake_fd)
+                if pending_focus is not None:
+                    focused, pending_focus = pending_focus, None
+                    set_suspended(not focused)
+                if pending_profile_index is not None:
+                    index, pending_profile_index = pending_profile_index, None
+                    switch_profile(index)
+            if timers and timers[0][0] <= time.monotonic():
+                run_due_timers(time.monotonic())
+                device.syn()
+    except OSError as e:
+        # Typically ENODEV from read() after the keyboard or mouse was unplugged
+        log(f"Input device read failed: {e}", ERROR)
+        reason = "Input device lost"
+    finally:
+        # Leave every button and axis neutral before the process goes away, whatever stopped the loop
+        write_neutral_frame()
+        request_exit(reason)
+
+CENTERING_INTERVAL = 0.02  # 50 Hz
+
+# Centering target, kept by x_worker_thread and only recomputed on RandR / ConfigureNotify events
+randr_event_base = None  # first RandR event code, None without the extension
+monitor_center = (0, 0)
+followed_window = None  # emulator window to centre on instead (CENTER_TARGET=window)
+window_center = None
+
+def x_monitor_center():
+    """Centre of the primary RandR output, or of the first lit one if none is primary."""
     screen = disp.screen()
-    center_x = screen.width_in_pixels // 2
-    center_y = screen.height_in_pixels // 2
+    fallback = (screen.width_in_pixels // 2, screen.height_in_pixels // 2)
+    if randr_event_base is None:
+        return fallback
+    try:
+        x_round_trips['worker'] += 2
+        resources = root.xrandr_get_screen_resources()
+        outputs = list(resources.outputs)
+        primary = root.xrandr_get_output_primary().output
+        if primary:
+            outputs.insert(0, primary)
+        for output in outputs:
+            x_round_trips['worker'] += 1
+            crtc = disp.xrandr_get_output_info(output, resources.config_timestamp).crtc
+            if crtc:
+                x_round_trips['worker'] += 1
+                info = disp.xrandr_get_crtc_info(crtc, resources.config_timestamp)
+                return info.x + info.width // 2, info.y + info.height // 2
+    except Exception as e:
+        log(f"RandR query failed, centering on the whole screen. Error: {e}", WARNING)
+    return fallback
 
-    while not exiting.is_set():
+def x_window_center(window):
+    x_round_trips['worker'] += 2
+    try:
+        geometry = window.get_geometry()
+        origin = root.translate_coords(window, 0, 0)
+    except Exception:
+        return None  # window already gone
+    return origin.x + geometry.width // 2, origin.y + geometry.height // 2
+
+def x_follow_window(window_id):
+    """Centre on this window (None: back to the monitor) and track its moves and resizes."""
+    global followed_window, window_center
+    followed_window = None
+    window_center = None
+    if window_id is None:
+        return
+    window = disp.create_resource_object('window', window_id)
+    try:
+        window.change_attributes(event_mask=X.StructureNotifyMask)
+    except Exception:
+        return
+    followed_window = window
+    window_center = x_window_center(window)
+
+def x_handle_event(event):
+    global monitor_center, followed_window, window_center
+    if followed_window is not None and getattr(event, 'window', None) == followed_window:
+        if event.type == X.ConfigureNotify:
+            window_center = x_window_center(followed_window)
+        elif event.type == X.DestroyNotify:
+            followed_window = window_center = None
+    elif randr_event_base is not None and event.type in (randr_event_base + randr.RRScreenChangeNotify,
+                                                         randr_event_base + randr.RRNotify):
+        monitor_center = x_monitor_center()
+
+def x_worker_thread():
+    """Owns disp: runs queued X commands and keeps the cursor centred while that is on."""
+    global randr_event_base, monitor_center
+    extension = disp.query_extension('RANDR')
+    if extension is not None and extension.present:
+        randr_event_base = extension.first_event
+        root.xrandr_select_input(randr.RRScreenChangeNotifyMask | randr.RRCrtcChangeNotifyMask)
+    monitor_center = x_monitor_center()
+    xfd = disp.fileno()
+    next_center = time.monotonic()
+
+    while True:
+        # Geometry changes; pointer grab events and the like are just drained. Checked on every
+        # pass, not only when xfd is readable: a reply (query_pointer, RandR, geometry) may have
+        # pulled events into Xlib's queue, and then the socket has nothing left to signal.
+        for _ in range(disp.pending_events()):
+            x_handle_event(disp.next_event())
+        timeout = None
         if cursor_centering_enabled.is_set():
-            data = root.query_pointer()
-            cur_x, cur_y = data.root_x, data.root_y
-            if abs(cur_x - center_x) > 5 or abs(cur_y - center_y) > 5:
+            timeout = max(0.0, next_center - time.monotonic())
+        ready, _, _ = select.select([x_wake_fd, shutdown_fd, xfd], [], [], timeout)
+        if x_wake_fd in ready:
+            os.eventfd_read(x_wake_fd)
+        while x_commands:
+            x_commands.popleft()()
+        if shutdown_fd in ready:
+            break
+        now = time.monotonic()
+        if cursor_centering_enabled.is_set() and now >= next_center:
+            next_center = now + CENTERING_INTERVAL
+            center_x, center_y = window_center or monitor_center
+            x_round_trips['worker'] += 1
+            data = root.query_pointer()  # needs a reply, so it is a round-trip
+            if abs(data.root_x - center_x) > 5 or abs(data.root_y - center_y) > 5:
                 root.warp_pointer(center_x, center_y)
-                disp.sync()
-        time.sleep(0.02)  # 50 Hz
+                disp.flush()
+
+    if cursor_locked.is_set():
+        x_ungrab_cursor()
+
+# Metrics endpoint: Prometheus text format, over HTTP if the scraper sends a request and as
+# bare text otherwise (e.g. socat - UNIX-CONNECT:/run/whisk.sock)
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+last_scrape = None  # (time, x round-trips) at the previous scrape, for the per-second gauge
+
+def render_metrics():
+    global last_scrape
+    now = time.monotonic()
+    round_trips = sum(x_round_trips.values())
+    rate = 0.0
+    if last_scrape is not None and now > last_scrape[0]:
+        rate = (round_trips - last_scrape[1]) / (now - last_scrape[0])
+    last_scrape = (now, round_trips)
+    devices = {keyboard.fd: 'keyboard', mouse.fd: 'mouse'}
+
+    lines = []
+    def metric(name, kind, description, samples):
+        lines.append(f"# HELP whisk_{name} {description}")
+        lines.append(f"# TYPE whisk_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"whisk_{name}{labels} {value}")
+
+    metric('events_read_total', 'counter', "Input events read per device.",
+           [(f'{{device="{devices[fd]}"}}', count) for fd, count in events_read.items()])
+    metric('output_writes_total', 'counter', "Axis and button writes to the virtual pad.", [('', counters['writes'])])
+    metric('output_frames_total', 'counter', "SYN_REPORT frames written to the virtual pad.",
+           [('', counters['frames_written'])])
+    metric('suppressed_batches_total', 'counter', "Input batches that wrote nothing (autorepeat, unbound keys).",
+           [('', counters['suppressed_batches'])])
+    metric('autorepeat_dropped_total', 'counter', "Kernel autorepeat events dropped at the reader.",
+           [('', counters['autorepeat_dropped'])])
+    metric('log_messages_dropped_total', 'counter', "Log messages dropped because the queue was full.",
+           [('', log_dropped)])
+    metric('syn_dropped_total', 'counter', "SYN_DROPPED (events lost by the kernel) per device.",
+           [(f'{{device="{name}"}}', count) for name, count in syn_dropped_counts.items()])
+    metric('hotkey_hits_total', 'counter', "Hotkey activations.",
+           [(f'{{hotkey="{name}"}}', count) for name, count in hotkey_hits.items()])
+    metric('x_round_trips_total', 'counter', "X requests that waited for a reply, per X connection.",
+           [(f'{{connection="{name}"}}', count) for name, count in x_round_trips.items()])
+    metric('x_round_trips_per_second', 'gauge', "X round-trips per second since the previous scrape.",
+           [('', f"{rate:.3f}")])
+    metric('sensitivity', 'gauge', "Current mouse sensitivity.", [('', current_sensitivity)])
+    metric('profile', 'gauge', "Index of the active profile.", [('', active_profile_index)])
+    metric('toggle', 'gauge', "Runtime toggles (1 = on).",
+           [('{toggle="centering"}', int(cursor_centering_enabled.is_set())),
+            ('{toggle="smoothing"}', int(mouse_smoothing_enabled.is_set())),
+            ('{toggle="cursor_lock"}', int(cursor_locked.is_set())),
+            ('{toggle="suspended"}', int(suspended))])
+
+    cumulative = list(itertools.accumulate(latency_buckets))
+    samples = [(f'_bucket{{le="{bound}"}}', count) for bound, count in zip(LATENCY_BOUNDS, cumulative)]
+    samples += [('_bucket{le="+Inf"}', cumulative[-1]), ('_sum', f"{latency_sum:.6f}"), ('_count', cumulative[-1])]
+    metric('input_latency_seconds', 'histogram', "Kernel event time to the virtual pad frame it caused.", samples)
+    return '\n'.join(lines) + '\n'
+
+def open_metrics_socket(address):
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            # Only a socket left over from an earlier run is replaced, never some other file
+            if not stat.S_ISSOCK(mode):
+                raise ValueError(f"'{path}' exists and is not a socket")
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+    else:
+        host, _, port = address.rpartition(':')
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host or '127.0.0.1', int(port)))
+    server.listen(4)
+    return server
+
+def metrics_thread(server):
+    while True:
+        ready, _, _ = select.select([server, shutdown_fd], [], [])
+        if shutdown_fd in ready:
+            break
+        conn, _ = server.accept()
+        try:
+            # An HTTP scraper sends its request first; a bare client may send nothing at all
+            request = b''
+            if select.select([conn], [], [], 0.2)[0]:
+                request = conn.recv(4096)
+            body = render_metrics().encode()
+            if request.startswith(b'GET'):
+                conn.sendall(f"HTTP/1.0 200 OK\r\nContent-Type: {METRICS_CONTENT_TYPE}\r\n"
+                             f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            else:
+                conn.sendall(body)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+    server.close()
+    if args.metrics.startswith('unix:'):
+        try:
+            os.unlink(args.metrics[len('unix:'):])
+        except OSError:
+            pass
 
 # Initialize neutral states
-device.emit(uinput.ABS_X, 128)
-device.emit(uinput.ABS_Y, 128)
-device.emit(uinput.ABS_RX, 128)
-device.emit(uinput.ABS_RY, 128)
+device.emit(uinput.ABS_X, STICK_CENTER)
+device.emit(uinput.ABS_Y, STICK_CENTER)
+device.emit(uinput.ABS_RX, STICK_CENTER)
+device.emit(uinput.ABS_RY, STICK_CENTER)
 device.emit(uinput.ABS_Z, 0)
 device.emit(uinput.ABS_RZ, 0)
 device.syn()
 
+# Keys already down (e.g. the Enter that started us) count as held, so their releases and
+# any modifiers line up, but they press nothing until they go down again
+held_keys.update(keyboard.active_keys())
+
+if profiles[active_profile_index]['grab']:
+    grab_cursor()
+
+# Exclusive keyboard grab; only then is it safe to turn kernel autorepeat off, since nothing
+# else reads this keyboard while we hold it
+saved_repeat = None
+
+def grab_keyboard():
+    global saved_repeat
+    keyboard.grab()
+    log("Keyboard grabbed exclusively.")
+    if args.no_autorepeat:
+        saved_repeat = tuple(keyboard.repeat)
+        keyboard.repeat = (saved_repeat[0], 0)  # a zero period disables repeat
+        log(f"Kernel autorepeat off (was {saved_repeat[0]} ms delay, {saved_repeat[1]} ms period).")
+
+def release_keyboard():
+    global saved_repeat
+    if saved_repeat is not None:
+        keyboard.repeat = saved_repeat
+        saved_repeat = None
+    keyboard.ungrab()
+    log("Keyboard released.")
+
+if args.grab_keyboard:
+    grab_keyboard()
+elif args.no_autorepeat:
+    log("--no-autorepeat needs --grab-keyboard, leaving kernel autorepeat on.", WARNING)
+
 # Start threads
-threads = []
-threads.append(threading.Thread(target=keyboard_thread, daemon=True))
-threads.append(threading.Thread(target=mouse_thread, daemon=True))
-threads.append(threading.Thread(target=cursor_centerer_thread, daemon=True))
+input_worker = threading.Thread(target=input_thread, daemon=True)
+threads = [input_worker]
+x_worker = None
+if args.no_x:
+    if args.suspend_unfocused or any(p['wm_class'] for p in profiles):
+        log("No X server (--no-x): WM_CLASS profile switching and --suspend-unfocused are off.", WARNING)
+else:
+    x_worker = threading.Thread(target=x_worker_thread, daemon=True)
+    threads.append(x_worker)
+    if args.suspend_unfocused or any(p['wm_class'] for p in profiles):
+        threads.append(threading.Thread(target=focus_profile_thread, daemon=True))
+
+if args.metrics:
+    try:
+        metrics_server = open_metrics_socket(args.metrics)
+    except (OSError, ValueError) as e:
+        log(f"Metrics endpoint '{args.metrics}' unavailable: {e}", WARNING)
+    else:
+        threads.append(threading.Thread(target=metrics_thread, args=(metrics_server,), daemon=True))
+        log(f"Serving metrics on {args.metrics}.")
 
 for t in threads:
     t.start()
 
-print("Virtual Xbox controller running.")
-print(f"Current mouse sensitivity: {current_sensitivity}. Press V to cycle.")
-print("Press Q/Z for left/right stick click.")
-print("Left mouse button mapped to Right Trigger (analog).")
-print("Middle mouse button mapped to Left Trigger (analog).")
-print(f"Press {loaded_keymap['BTN_MODE']} for BTN_MODE (Guide button).")
-print(f"Press {loaded_keymap['BTN_TL2']} for digital Left Trigger (BTN_TL2).")
-print(f"Press {loaded_keymap['BTN_TR2']} for digital Right Trigger (BTN_TR2).")
-print("Press Shift+Alt+P to toggle cursor centering ON/OFF.")
-print("Press N to toggle cursor lock ON/OFF.")
-print("Press Shift+X+Q+S for EMERGENCY switch (quit script).")
-print("Press M to toggle mouse smoothing ON/OFF.")
-print("Press H to show keybindings.")
-print("Ctrl+C to exit.")
+log("Virtual Xbox controller running.")
+log(f"Current mouse sensitivity: {current_sensitivity}. Press V to cycle.")
+log("Press Q/Z for left/right stick click.")
+log(describe_mouse_bindings())
+log(f"Press {loaded_keymap['BTN_MODE']} for BTN_MODE (Guide button).")
+log(f"Press {loaded_keymap['BTN_TL2']} for digital Left Trigger (BTN_TL2).")
+log(f"Press {loaded_keymap['BTN_TR2']} for digital Right Trigger (BTN_TR2).")
+log("Press Shift+Alt+P to toggle cursor centering ON/OFF.")
+log("Press N to toggle cursor lock ON/OFF.")
+log("Press Shift+X+Q+S for EMERGENCY switch (quit script).")
+log("Press M to toggle mouse smoothing ON/OFF (the mouse polling rate is reported after the first moves).")
+log("Press Shift+Alt+1..9 to switch profile.")
+log("Press Shift+Alt+D (or send SIGUSR1) to dump the flight recorder.")
+log("Press H to show keybindings.")
+log("Ctrl+C to exit.")
+
+def on_signal(signum, _frame):
+    request_exit(f"Got {signal.Signals(signum).name}")
+
+for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+    signal.signal(signum, on_signal)
+signal.signal(signal.SIGUSR1, lambda _signum, _frame: flight_recorder.dump('signal'))
+
+# Uncaught exceptions in any thread dump the flight recorder before the usual traceback
+def dump_on_crash(hook):
+    def crashed(*exc):
+        flight_recorder.dump('crash')
+        hook(*exc)
+    return crashed
+
+sys.excepthook = dump_on_crash(sys.excepthook)
+threading.excepthook = dump_on_crash(threading.excepthook)
 
 try:
+    # Signal handlers and the emergency hotkey both end up writing shutdown_fd
     while not exiting.is_set():
-        time.sleep(1)
-except KeyboardInterrupt:
-    print("Exiting on Ctrl+C...")
+        select.select([shutdown_fd], [], [])
 finally:
-    if cursor_locked.is_set():
-        ungrab_cursor()
-    exiting.set()
-    time.sleep(0.3)
-    print("Exited cleanly.")
+    request_exit("Shutting down")
+    input_worker.join(timeout=1.0)  # it writes the neutral frame on its way out
+    if x_worker is not None:
+        x_worker.join(timeout=1.0)  # and this one releases the pointer grab
+    elif cursor_locked.is_set():
+        evdev_ungrab_mouse()
+    if args.grab_keyboard and not suspended:
+        release_keyboard()
+    print_turbo_stats()
+    log(f"SYN_DROPPED (events lost, state re-read): keyboard {syn_dropped_counts['keyboard']}, "
+          f"mouse {syn_dropped_counts['mouse']}")
+    log("Exited cleanly.")
+    stop_logging()
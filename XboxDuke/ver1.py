@@ -6,6 +6,9 @@ from collections import deque
 from Xlib import display, X
 import sys
 import os
+import select
+import struct
+import ctypes
 
 # Initialize X11 display for cursor warping and grabbing
 disp = display.Display()
@@ -91,47 +94,83 @@ def load_keymap_from_file(filepath):
 
 print(f"Looking for config file '{CONFIG_FILENAME}' in current directory: {os.getcwd()}")
 
-loaded_keymap = {}
-if os.path.isfile(CONFIG_FILENAME):
-    raw_map = load_keymap_from_file(CONFIG_FILENAME)
-    def get_key(k, default=None):
-        return raw_map.get(k, default)
-    # Axis keys parsing if provided as comma separated, fallback to defaults
-    xs = get_key('ABS_LEFT_STICK_X', None)
-    if xs and ',' in xs:
-        pos_key, neg_key = [k.strip() for k in xs.split(',', 1)]
+def read_keymap():
+    """Build the keymap from CONFIG_FILENAME, or the defaults when there is no such file."""
+    if os.path.isfile(CONFIG_FILENAME):
+        raw_map = load_keymap_from_file(CONFIG_FILENAME)
+        def get_key(k, default=None):
+            return raw_map.get(k, default)
+        # Axis keys parsing if provided as comma separated, fallback to defaults
+        xs = get_key('ABS_LEFT_STICK_X', None)
+        if xs and ',' in xs:
+            pos_key, neg_key = [k.strip() for k in xs.split(',', 1)]
+        else:
+            pos_key = get_key('ABS_LEFT_STICK_X_POS', DEFAULT_KEYMAP['ABS_LEFT_STICK_X_POS'])
+            neg_key = get_key('ABS_LEFT_STICK_X_NEG', DEFAULT_KEYMAP['ABS_LEFT_STICK_X_NEG'])
+        ys = get_key('ABS_LEFT_STICK_Y', None)
+        if ys and ',' in ys:
+            posy_key, negy_key = [k.strip() for k in ys.split(',', 1)]
+        else:
+            posy_key = get_key('ABS_LEFT_STICK_Y_POS', DEFAULT_KEYMAP['ABS_LEFT_STICK_Y_POS'])
+            negy_key = get_key('ABS_LEFT_STICK_Y_NEG', DEFAULT_KEYMAP['ABS_LEFT_STICK_Y_NEG'])
+
+        keymap = {
+            'BTN_A': get_key('BTN_A', DEFAULT_KEYMAP['BTN_A']),
+            'BTN_B': get_key('BTN_B', DEFAULT_KEYMAP['BTN_B']),
+            'BTN_X': get_key('BTN_X', DEFAULT_KEYMAP['BTN_X']),
+            'BTN_Y': get_key('BTN_Y', DEFAULT_KEYMAP['BTN_Y']),
+            'BTN_BLACK': get_key('BTN_BLACK', DEFAULT_KEYMAP['BTN_BLACK']),
+            'BTN_WHITE': get_key('BTN_WHITE', DEFAULT_KEYMAP['BTN_WHITE']),
+            'BTN_START': get_key('BTN_START', DEFAULT_KEYMAP['BTN_START']),
+            'BTN_BACK': get_key('BTN_BACK', DEFAULT_KEYMAP['BTN_BACK']),
+            'BTN_DPAD_UP': get_key('BTN_DPAD_UP', DEFAULT_KEYMAP['BTN_DPAD_UP']),
+            'BTN_DPAD_DOWN': get_key('BTN_DPAD_DOWN', DEFAULT_KEYMAP['BTN_DPAD_DOWN']),
+            'BTN_DPAD_LEFT': get_key('BTN_DPAD_LEFT', DEFAULT_KEYMAP['BTN_DPAD_LEFT']),
+            'BTN_DPAD_RIGHT': get_key('BTN_DPAD_RIGHT', DEFAULT_KEYMAP['BTN_DPAD_RIGHT']),
+            'ABS_LEFT_STICK_X_POS': pos_key,
+            'ABS_LEFT_STICK_X_NEG': neg_key,
+            'ABS_LEFT_STICK_Y_POS': posy_key,
+            'ABS_LEFT_STICK_Y_NEG': negy_key,
+        }
+        print(f"Loaded keymap from '{CONFIG_FILENAME}': {keymap}")
     else:
-        pos_key = get_key('ABS_LEFT_STICK_X_POS', DEFAULT_KEYMAP['ABS_LEFT_STICK_X_POS'])
-        neg_key = get_key('ABS_LEFT_STICK_X_NEG', DEFAULT_KEYMAP['ABS_LEFT_STICK_X_NEG'])
-    ys = get_key('ABS_LEFT_STICK_Y', None)
-    if ys and ',' in ys:
-        posy_key, negy_key = [k.strip() for k in ys.split(',', 1)]
-    else:
-        posy_key = get_key('ABS_LEFT_STICK_Y_POS', DEFAULT_KEYMAP['ABS_LEFT_STICK_Y_POS'])
-        negy_key = get_key('ABS_LEFT_STICK_Y_NEG', DEFAULT_KEYMAP['ABS_LEFT_STICK_Y_NEG'])
-
-    loaded_keymap = {
-        'BTN_A': get_key('BTN_A', DEFAULT_KEYMAP['BTN_A']),
-        'BTN_B': get_key('BTN_B', DEFAULT_KEYMAP['BTN_B']),
-        'BTN_X': get_key('BTN_X', DEFAULT_KEYMAP['BTN_X']),
-        'BTN_Y': get_key('BTN_Y', DEFAULT_KEYMAP['BTN_Y']),
-        'BTN_BLACK': get_key('BTN_BLACK', DEFAULT_KEYMAP['BTN_BLACK']),
-        'BTN_WHITE': get_key('BTN_WHITE', DEFAULT_KEYMAP['BTN_WHITE']),
-        'BTN_START': get_key('BTN_START', DEFAULT_KEYMAP['BTN_START']),
-        'BTN_BACK': get_key('BTN_BACK', DEFAULT_KEYMAP['BTN_BACK']),
-        'BTN_DPAD_UP': get_key('BTN_DPAD_UP', DEFAULT_KEYMAP['BTN_DPAD_UP']),
-        'BTN_DPAD_DOWN': get_key('BTN_DPAD_DOWN', DEFAULT_KEYMAP['BTN_DPAD_DOWN']),
-        'BTN_DPAD_LEFT': get_key('BTN_DPAD_LEFT', DEFAULT_KEYMAP['BTN_DPAD_LEFT']),
-        'BTN_DPAD_RIGHT': get_key('BTN_DPAD_RIGHT', DEFAULT_KEYMAP['BTN_DPAD_RIGHT']),
-        'ABS_LEFT_STICK_X_POS': pos_key,
-        'ABS_LEFT_STICK_X_NEG': neg_key,
-        'ABS_LEFT_STICK_Y_POS': posy_key,
-        'ABS_LEFT_STICK_Y_NEG': negy_key,
-    }
-    print(f"Loaded keymap from '{CONFIG_FILENAME}': {loaded_keymap}")
-else:
-    print(f"Config file '{CONFIG_FILENAME}' not found, using default keymap.")
-    loaded_keymap = DEFAULT_KEYMAP.copy()
+        print(f"Config file '{CONFIG_FILENAME}' not found, using default keymap.")
+        keymap = DEFAULT_KEYMAP.copy()
+    return keymap
+
+loaded_keymap = read_keymap()
+
+def check_keymap(keymap):
+    """Warn about bindings that are unknown, shadowed by an earlier one or clash with hotkeys."""
+    hotkeys = {'KEY_V': 'V (cycle sensitivity)', 'KEY_N': 'N (cursor lock)',
+               'KEY_M': 'M (mouse smoothing)', 'KEY_H': 'H (help)'}
+    owners = {}
+    for entry, keyname in keymap.items():
+        if not isinstance(keyname, str):
+            continue  # mouse trigger codes
+        if not keyname.startswith(('KEY_', 'BTN_')) or keyname not in evdev.ecodes.ecodes:
+            print(f"Keymap problem: {entry}={keyname}: unknown key name, binding ignored")
+            continue
+        if keyname in hotkeys:
+            print(f"Keymap problem: {entry}={keyname}: collides with the {hotkeys[keyname]} hotkey")
+        # Buttons, left stick X and left stick Y are three separate if/elif chains: within a
+        # chain the earlier entry wins, across chains one key fires in each of them
+        if entry.startswith('ABS_LEFT_STICK_X'):
+            group = 'x axis'
+        elif entry.startswith('ABS_LEFT_STICK_Y'):
+            group = 'y axis'
+        else:
+            group = 'button'
+        if (group, keyname) in owners:
+            print(f"Keymap problem: {entry}={keyname}: shadowed by {owners[(group, keyname)]}, can never fire")
+        else:
+            owners[(group, keyname)] = entry
+    # A key on one stick axis and the other is a diagonal; on a button and an axis it is a clash
+    for (group, keyname), entry in owners.items():
+        if group != 'button' and ('button', keyname) in owners:
+            print(f"Keymap problem: {entry}={keyname}: same key also drives {owners[('button', keyname)]}")
+
+check_keymap(loaded_keymap)
 
 def parse_keycode(keyname):
     # Returns evdev key code integer or string key for matching ev.keycode
@@ -325,6 +364,75 @@ def hotkey_check(event_key, pressed):
         elif not pressed:
             hotkey_check.h_down = False
 
+# inotify (via libc, no extra dependency) used to hot-reload the keymap file
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT_FORMAT = 'iIII'  # wd, mask, cookie, len; followed by len bytes of name
+INOTIFY_EVENT_SIZE = struct.calcsize(INOTIFY_EVENT_FORMAT)
+
+keymap_lock = threading.Lock()
+
+def open_config_watch():
+    """Watch the config file's directory (editors often replace the file); returns an fd or None."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        config_dir = os.path.dirname(os.path.abspath(CONFIG_FILENAME))
+        if libc.inotify_add_watch(fd, os.fsencode(config_dir), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, os.strerror(err))
+    except (OSError, AttributeError) as e:
+        print(f"Keymap hot-reload unavailable: {e}")
+        return None
+    print(f"Watching '{CONFIG_FILENAME}' for changes.")
+    return fd
+
+def config_changed(fd):
+    """Read pending inotify events; True if any of them concerned CONFIG_FILENAME."""
+    data = os.read(fd, 4096)
+    target = os.fsencode(os.path.basename(CONFIG_FILENAME))
+    changed = False
+    offset = 0
+    while offset < len(data):
+        _wd, _mask, _cookie, length = struct.unpack_from(INOTIFY_EVENT_FORMAT, data, offset)
+        offset += INOTIFY_EVENT_SIZE
+        if data[offset:offset + length].rstrip(b'\0') == target:
+            changed = True
+        offset += length
+    return changed
+
+def reload_keymap():
+    global loaded_keymap, left_x, left_y
+    keymap = read_keymap()
+    check_keymap(keymap)
+    with keymap_lock:
+        # Release what the old bindings were holding; keys still down are forgotten so
+        # their release can't let go of something the new bindings pressed
+        for event in device_events:
+            if event[0] == 0x01:  # EV_KEY
+                device.emit(event, 0, syn=False)
+        left_x, left_y = 128, 128
+        device.emit(uinput.ABS_X, left_x, syn=False)
+        device.emit(uinput.ABS_Y, left_y, syn=False)
+        device.syn()
+        with held_keys_lock:
+            held_keys.clear()
+        loaded_keymap = keymap
+    print("Keymap reloaded.")
+
+def config_watch_thread():
+    fd = open_config_watch()
+    if fd is None:
+        return
+    while not exiting.is_set():
+        ready, _, _ = select.select([fd], [], [], 1.0)
+        if ready and config_changed(fd):
+            reload_keymap()
+
 def keyboard_thread():
     global left_x, left_y, current_sensitivity_index, current_sensitivity
 
@@ -333,7 +441,11 @@ def keyboard_thread():
     for event in keyboard.read_loop():
         if exiting.is_set():
             break
-        if event.type == evdev.ecodes.EV_KEY:
+        if event.type != evdev.ecodes.EV_KEY:
+            continue
+        # A reload swaps the keymap between events, never in the middle of one
+        with keymap_lock:
+            keymap = loaded_keymap
             ev = evdev.categorize(event)
             key = ev.keycode if isinstance(ev.keycode, str) else ev.keycode
             pressed = ev.keystate in (evdev.KeyEvent.key_down, evdev.KeyEvent.key_hold)
@@ -366,43 +478,43 @@ def keyboard_thread():
                 n_was_down = pressed
 
             # Map button presses/releases to virtual device
-            if key == loaded_keymap['BTN_A']:
+            if key == keymap['BTN_A']:
                 device.emit(uinput.BTN_A, pressed)
-            elif key == loaded_keymap['BTN_B']:
+            elif key == keymap['BTN_B']:
                 device.emit(uinput.BTN_B, pressed)
-            elif key == loaded_keymap['BTN_X']:
+            elif key == keymap['BTN_X']:
                 device.emit(uinput.BTN_X, pressed)
-            elif key == loaded_keymap['BTN_Y']:
+            elif key == keymap['BTN_Y']:
                 device.emit(uinput.BTN_Y, pressed)
-            elif key == loaded_keymap['BTN_BLACK']:
+            elif key == keymap['BTN_BLACK']:
                 device.emit(uinput.BTN_TL2, pressed)
-            elif key == loaded_keymap['BTN_WHITE']:
+            elif key == keymap['BTN_WHITE']:
                 device.emit(uinput.BTN_TR2, pressed)
-            elif key == loaded_keymap['BTN_START']:
+            elif key == keymap['BTN_START']:
                 device.emit(uinput.BTN_START, pressed)
-            elif key == loaded_keymap['BTN_BACK']:
+            elif key == keymap['BTN_BACK']:
                 device.emit(uinput.BTN_SELECT, pressed)
-            elif key == loaded_keymap['BTN_DPAD_UP']:
+            elif key == keymap['BTN_DPAD_UP']:
                 device.emit(uinput.BTN_DPAD_UP, pressed)
-            elif key == loaded_keymap['BTN_DPAD_DOWN']:
+            elif key == keymap['BTN_DPAD_DOWN']:
                 device.emit(uinput.BTN_DPAD_DOWN, pressed)
-            elif key == loaded_keymap['BTN_DPAD_LEFT']:
+            elif key == keymap['BTN_DPAD_LEFT']:
                 device.emit(uinput.BTN_DPAD_LEFT, pressed)
-            elif key == loaded_keymap['BTN_DPAD_RIGHT']:
+            elif key == keymap['BTN_DPAD_RIGHT']:
                 device.emit(uinput.BTN_DPAD_RIGHT, pressed)
 
             # Left stick axes (two keys per axis)
-            if key == loaded_keymap['ABS_LEFT_STICK_X_POS']:
+            if key == keymap['ABS_LEFT_STICK_X_POS']:
                 left_x = 255 if pressed else 128
                 device.emit(uinput.ABS_X, left_x, syn=False)
-            elif key == loaded_keymap['ABS_LEFT_STICK_X_NEG']:
+            elif key == keymap['ABS_LEFT_STICK_X_NEG']:
                 left_x = 0 if pressed else 128
                 device.emit(uinput.ABS_X, left_x, syn=False)
 
-            if key == loaded_keymap['ABS_LEFT_STICK_Y_POS']:
+            if key == keymap['ABS_LEFT_STICK_Y_POS']:
                 left_y = 255 if pressed else 128
                 device.emit(uinput.ABS_Y, left_y, syn=False)
-            elif key == loaded_keymap['ABS_LEFT_STICK_Y_NEG']:
+            elif key == keymap['ABS_LEFT_STICK_Y_NEG']:
                 left_y = 0 if pressed else 128
                 device.emit(uinput.ABS_Y, left_y, syn=False)
 
@@ -462,7 +574,8 @@ device.syn()
 threads = [
     threading.Thread(target=keyboard_thread, daemon=True),
     threading.Thread(target=mouse_thread, daemon=True),
-    threading.Thread(target=cursor_centerer_thread, daemon=True)
+    threading.Thread(target=cursor_centerer_thread, daemon=True),
+    threading.Thread(target=config_watch_thread, daemon=True)
 ]
 
 for t in threads: